@@ -8,8 +8,10 @@ import json
 from src import database
 from src import discord
 from src import util
+from src import votingportal
+from src import metrics
 from src.socialmedia import Tweeter, Reddit, Gab
-from src.votingportal import SmartCashProposals
+from src.votingportal import SmartCashProposals, PortalSession, PollScheduler
 
 __version__ = "1.0"
 
@@ -122,24 +124,80 @@ def main(argv):
     except:
         pass
 
+    # SQLite tuning for both databases
+    try:
+        pragmas = {'synchronous': config.get('database', 'synchronous', fallback='NORMAL'),
+                   'cache_size': config.getint('database', 'cache_size', fallback=-8000),
+                   'mmap_size': config.getint('database', 'mmap_size', fallback=0)}
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
+
+    if pragmas['synchronous'].upper() not in ['OFF', 'NORMAL', 'FULL', 'EXTRA']:
+        sys.exit("Invalid synchronous mode {}. Use one of OFF, NORMAL, FULL, EXTRA".format(pragmas['synchronous']))
+
     # Load the user database
-    botdb = database.BotDatabase(directory + '/bot.db')
+    botdb = database.BotDatabase(directory + '/bot.db', pragmas)
 
     # Load the proposals database
-    proposaldb = database.ProposalDatabase(directory + '/proposals.db')
+    proposaldb = database.ProposalDatabase(directory + '/proposals.db', pragmas)
+
+    # Setup the connection pool for the voting portal requests
+    try:
+        session = PortalSession(poolSize = config.getint('voting', 'pool_size', fallback=4),
+                                keepAlive = config.getboolean('voting', 'keep_alive', fallback=True),
+                                gzip = config.getboolean('voting', 'gzip', fallback=True),
+                                listTimeout = config.getfloat('voting', 'list_timeout', fallback=20),
+                                detailTimeout = config.getfloat('voting', 'detail_timeout', fallback=20))
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
+
+    try:
+        detailWorkers = config.getint('voting', 'detail_workers', fallback=4)
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
+
+    poller = config.get('voting', 'poller', fallback=votingportal.pollerThread)
+
+    if not poller in votingportal.validPollers:
+        sys.exit("Invalid poller {}. Use one of {}".format(poller, ", ".join(votingportal.validPollers)))
+
+    # Setup the adaptive poll interval
+    try:
+        scheduler = PollScheduler(interval = config.getfloat('voting', 'poll_interval', fallback=120),
+                                  minimum = config.getfloat('voting', 'poll_min', fallback=30),
+                                  maximum = config.getfloat('voting', 'poll_max', fallback=900),
+                                  jitter = config.getfloat('voting', 'poll_jitter', fallback=0.1))
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
 
     # Create the proposal list manager
-    proposals = SmartCashProposals(proposaldb)
+    proposals = SmartCashProposals(proposaldb, session, detailWorkers, poller, scheduler)
+
+    try:
+        notifyWorkers = config.getint('notifications', 'workers', fallback=4)
+        coalesceWindow = config.getfloat('notifications', 'coalesce_window', fallback=0)
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
 
     bot = None
 
     if config.get('bot', 'app') == 'telegram':
         sys.exit("Telegram is not supported yet.")
     elif config.get('bot', 'app') == 'discord':
-        bot = discord.SmartProposalsBotDiscord(config.get('bot','token'), admins, password, botdb, proposals, notifyChannel, tweeter, reddit, gab)
+        bot = discord.SmartProposalsBotDiscord(config.get('bot','token'), admins, password, botdb, proposals, notifyChannel, tweeter, reddit, gab, notifyWorkers, coalesceWindow)
     else:
         sys.exit("You need to set 'telegram' or 'discord' as 'app' in the configfile.")
 
+    # Optional Prometheus endpoint
+    try:
+        if config.getboolean('metrics', 'enabled', fallback=False):
+            metrics.MetricsServer(config.get('metrics', 'host', fallback='127.0.0.1'),
+                                  config.getint('metrics', 'port', fallback=9110)).start()
+    except ValueError as e:
+        sys.exit("Config value error {}".format(e))
+    except OSError as e:
+        sys.exit("Could not start the metrics server {}".format(e))
+
     # Start and run forever!
     bot.start()
 
@@ -3,6 +3,8 @@
 import logging
 from src import messages
 from src import util
+from src import database
+from src import metrics
 import requests
 import json
 import time
@@ -12,13 +14,20 @@ import discord
 
 logger = logging.getLogger("commands")
 
+# Periods in days for the active users in the stats
+statsActiveDays = [1, 7, 30]
+
+usersAdded = metrics.counter('bot_users_added_total', 'Users added to the database')
+commandSeconds = metrics.histogram('bot_command_seconds', 'Duration of the command handling including the response', ['command'])
+
 ######
-# Return the welcome message and add the user if its not already added
-#
+# Return the welcome message and add the user if its not already added.
+# :active records the activity of the user, not set for users who only
+# got mentioned.
 #
 # Gets only called by any command handler
 ######
-def checkUser(bot, message):
+def checkUser(bot, message, active = True):
     logger.info("checkUser")
 
     result = {'response':None, 'added':False}
@@ -27,9 +36,15 @@ def checkUser(bot, message):
     userId = userInfo['user'] if 'user' in userInfo else None
     userName = userInfo['name'] if 'name' in userInfo else "Unknown"
 
-    if not bot.database.getUser(userId) and bot.database.addUser(userId, userName):
+    if active:
+        bot.database.touchUser(userId)
+
+    # Known users are answered from memory, new ones get added in one query.
+    if not bot.database.isKnownUser(userId) and bot.database.addUser(userId, userName, active):
         logger.info("checkUser - new user {}".format(userName))
 
+        usersAdded.inc()
+
         result['added'] = True
 
         if bot.messenger == 'discord':
@@ -54,7 +69,7 @@ def proposalList(bot, proposals, title = "", fallback = ""):
     if len(proposals):
 
         for proposal in proposals:
-            response += messages.proposalShort(bot.messenger, proposal)
+            response += bot.renderCache.get(messages.proposalShort, bot.messenger, proposal)
     else:
         response += fallback
 
@@ -91,7 +106,7 @@ def latest(bot):
     proposal = bot.proposals.getLatestProposals()
 
     if proposal:
-        response += messages.proposalDetail(bot.messenger, proposal)
+        response += bot.renderCache.get(messages.proposalDetail, bot.messenger, proposal)
     else:
         response += "No latest proposal available!"
 
@@ -123,7 +138,7 @@ def detail(bot,args):
         proposal = bot.proposals.getProposal(proposalId)
 
         if proposal:
-            response += messages.proposalDetail(bot.messenger, proposal)
+            response += bot.renderCache.get(messages.proposalDetail, bot.messenger, proposal)
         else:
             response += "There is no info about the ID {}!\n\n".format(proposalId)
 
@@ -191,8 +206,7 @@ def subscription(bot, message, state):
     userName = userInfo['name'] if 'name' in userInfo else "Unknown"
     public = userInfo['public']
 
-    dbUser = bot.database.getUser(userId)
-    if not dbUser:
+    if not bot.database.isKnownUser(userId):
         logger.error("User not in db?!")
         response += messages.unexpectedError(bot.messenger)
     else:
@@ -221,8 +235,7 @@ def add(bot, message, args):
     userName = userInfo['name'] if 'name' in userInfo else "Unknown"
     public = userInfo['public']
 
-    dbUser = bot.database.getUser(userId)
-    if not dbUser:
+    if not bot.database.isKnownUser(userId):
         logger.error("User not in db?!")
         response += messages.unexpectedError(bot.messenger)
     else:
@@ -239,10 +252,7 @@ def add(bot, message, args):
                 response += messages.proposalNotFound(bot.messenger, args[0])
             else:
 
-                currentList = bot.database.getWatchlist(userId=userId)
-
-                if currentList and len(currentList) and\
-                   proposal.proposalId in list(map(lambda x: x['proposal_id'],currentList)):
+                if len(bot.database.getWatchlist(userId=userId, proposalId=proposal.proposalId)):
 
                    response += messages.proposalIsOnWatchlist(bot.messenger, proposal.title)
 
@@ -273,8 +283,7 @@ def remove(bot, message, args):
     userName = userInfo['name'] if 'name' in userInfo else "Unknown"
     public = userInfo['public']
 
-    dbUser = bot.database.getUser(userId)
-    if not dbUser:
+    if not bot.database.isKnownUser(userId):
         logger.error("User not in db?!")
         response += messages.unexpectedError(bot.messenger)
     else:
@@ -291,11 +300,7 @@ def remove(bot, message, args):
                 response += messages.proposalNotFound(bot.messenger, args[0])
             else:
 
-                currentList = bot.database.getWatchlist(userId=userId)
-
-                if currentList and len(currentList) and\
-                   not proposal.proposalId in list(map(lambda x: x['proposal_id'],currentList)) or\
-                   not currentList or not len(currentList):
+                if not len(bot.database.getWatchlist(userId=userId, proposalId=proposal.proposalId)):
 
                    response += messages.proposalIsNotOnWatchlist(bot.messenger, proposal.title)
 
@@ -326,8 +331,7 @@ def watchlist(bot, message):
     userName = userInfo['name'] if 'name' in userInfo else "Unknown"
     public = userInfo['public']
 
-    dbUser = bot.database.getUser(userId)
-    if not dbUser:
+    if not bot.database.isKnownUser(userId):
         logger.error("User not in db?!")
         response += "<b>Unexpected error. Contact the team!<b>"
     else:
@@ -360,13 +364,36 @@ def stats(bot):
 
     response = messages.markdown("<u><b>Statistics<b><u>\n\n",bot.messenger)
 
-    users = bot.database.getUsers()
-    subscriptions = bot.database.getSubscriptions()
-    watchlistEntries = bot.database.getWatchlist()
+    counts = bot.database.getAudienceCounts()
+
+    response += "User: {}\n".format(counts['users'])
+    response += "Subscriptions: {}\n".format(counts['subscribers'])
+    response += "Watchlist entires: {}\n".format(counts['watchlist'])
+
+    response += "\nActive users: {}\n".format(", ".join(["{} in {} day{}".format(bot.database.countActiveUsers(days * 86400), days, "s" if days > 1 else "") for days in statsActiveDays]))
+
+    openProposals = bot.proposals.getOpenProposals()
+
+    if len(openProposals):
 
-    response += "User: {}\n".format(len(users))
-    response += "Subscriptions: {}\n".format(len(subscriptions))
-    response += "Watchlist entires: {}\n".format(len(watchlistEntries))
+        response += "\nWatchers of the open proposals\n"
+
+        for proposal in openProposals:
+            response += "#{}: {}\n".format(proposal.proposalId, bot.database.countWatchers(proposal.proposalId))
+
+    outbox = bot.database.countOutbox()
+
+    response += "\nOutbox pending: {}, sent: {}, failed: {}\n".format(outbox.get(database.outboxPending, 0),
+                                                                       outbox.get(database.outboxSent, 0),
+                                                                       outbox.get(database.outboxFailed, 0))
+
+    dispatcher = bot.dispatcher.stats()
+
+    response += "\nNotification queue: {}\n".format(dispatcher['depth'])
+    response += "Notifications delivered: {}\n".format(dispatcher['delivered'])
+    response += "Notifications failed: {}\n".format(dispatcher['failed'])
+    response += "Notifications coalesced: {}\n".format(dispatcher['coalesced'])
+    response += "Delivery latency: {:.1f}s avg, {:.1f}s max\n".format(dispatcher['latencyAvg'], dispatcher['latencyMax'])
 
     return response
 
@@ -478,37 +505,27 @@ def new(bot):
 def handlePublishedProposal(bot, proposal):
 
     # Create notification response messages!
-    responses = {'message':messages.publishedProposalNotification(bot.messenger, proposal), 'userIds': []}
-
-    for user in bot.database.getSubscriptions():
-        responses['userIds'].append(user['id'])
+    responses = {'message':messages.publishedProposalNotification(bot.messenger, proposal), 'userIds': bot.database.getSubscribers()}
 
     return responses
 
 def handleExtendedProposal(bot, proposal):
 
     # Create notification response messages!
-    responses = {'message':messages.extendedProposalNotification(bot.messenger, proposal), 'userIds': []}
-
-    for user in bot.database.getSubscriptions():
-        responses['userIds'].append(user['id'])
+    responses = {'message':messages.extendedProposalNotification(bot.messenger, proposal), 'userIds': bot.database.getSubscribers()}
 
     return responses
 
 def handleReminderProposal(bot, proposal):
 
     # Create notification response messages!
-    responses = {'message':messages.reminderProposalNotification(bot.messenger, proposal), 'userIds': []}
-
-    for user in bot.database.getSubscriptions():
-        responses['userIds'].append(user['id'])
+    responses = {'message':messages.reminderProposalNotification(bot.messenger, proposal), 'userIds': bot.database.getSubscribers()}
 
     return responses
 
 def handleUpdatedProposal(bot, updated, proposal):
 
     # Create notification response messages!
-    responses = {}
     changes = []
 
     if 'voteYes' in updated and updated['voteYes']:
@@ -531,25 +548,21 @@ def handleUpdatedProposal(bot, updated, proposal):
         change = updated['currentStatus']
         changes.append("<b>Current result<b> changed from <b>{}<b> to <b>{}<b>\n".format(change['before'], change['now']))
 
-    for entry in bot.database.getWatchlist(proposalId=proposal.proposalId):
+    message = "<u><b>Watchlist update!<b><u>\n\n"
+    message += "The proposal <b>{}<b> obtained the following change{}\n\n".format(proposal.title, "s" if len(changes) > 1 else "")
 
-        message = "<u><b>Watchlist update!<b><u>\n\n"
-        message += "The proposal <b>{}<b> obtained the following change{}\n\n".format(proposal.title, "s" if len(changes) > 1 else "")
+    for change in changes:
+        message += change
 
-        for change in changes:
-            message += change
-
-        responses[entry['user_id']] = messages.markdown(message, bot.messenger)
+    # All watchers get the same message, render it only once.
+    responses = {'message': messages.markdown(message, bot.messenger), 'userIds': bot.database.getWatchers(proposal.proposalId)}
 
     return responses
 
 def handleEndedProposal(bot, proposal):
 
     # Create notification response messages!
-    responses = {'message':messages.endedProposalNotification(bot.messenger, proposal), 'userIds': []}
-
-    for user in bot.database.getSubscriptions():
-        responses['userIds'].append(user['id'])
+    responses = {'message':messages.endedProposalNotification(bot.messenger, proposal), 'userIds': bot.database.getSubscribers()}
 
     return responses
 
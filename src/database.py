@@ -2,11 +2,56 @@
 
 import logging
 from src import util
+from src import metrics
 import threading
+import time
+import asyncio
+import functools
 import sqlite3 as sql
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("database")
 
+asyncSeconds = metrics.histogram('database_async_seconds', 'Duration of the database calls from the event loop including the queue time', ['call'])
+
+# Delivery states of the notification outbox
+outboxPending = 0
+outboxSent = 1
+outboxFailed = 2
+
+# States of the broadcast jobs
+broadcastRunning = 0
+broadcastDone = 1
+broadcastCancelled = 2
+
+#####
+#
+# Bring the schema of the database behind :connection up to date. The
+# :migrations get applied in order, each in its own transaction. The
+# number of applied migrations is stored as user_version of the database.
+#
+#####
+
+def migrate(connection, migrations, name):
+
+    with connection.read() as db:
+        db.cursor.execute("PRAGMA user_version")
+        version = db.cursor.fetchone()[0]
+
+    if version > len(migrations):
+        logger.warning("migrate: {} database has the unknown version {}".format(name, version))
+        return version
+
+    for number, script in enumerate(migrations[version:], version + 1):
+
+        logger.info("migrate: {} database to version {}".format(name, number))
+
+        connection.script("BEGIN TRANSACTION;{};PRAGMA user_version={};COMMIT;".format(script, number))
+
+        version = number
+
+    return version
+
 #####
 #
 # Wrapper for the user database where all the users
@@ -16,48 +61,236 @@ logger = logging.getLogger("database")
 
 class BotDatabase(object):
 
-    def __init__(self, dburi):
+    ######
+    # Schema migrations, see migrate(). Never change an existing entry,
+    # append a new one instead.
+    ######
+    migrations = [
+        # 1 - Users and their watchlist
+        'CREATE TABLE IF NOT EXISTS "users" (\
+            `id` INTEGER NOT NULL PRIMARY KEY,\
+            `name` INTEGER,\
+            `subscription` INTEGER,\
+            `last_activity` INTEGER\
+        );\
+        CREATE TABLE IF NOT EXISTS "watchlist" (\
+            `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,\
+            `user_id` INTEGER,\
+            `proposal_id` INTEGER\
+        );',
+        # 2 - Notification outbox
+        'CREATE TABLE IF NOT EXISTS "outbox" (\
+            `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,\
+            `key` TEXT NOT NULL UNIQUE,\
+            `user_id` INTEGER,\
+            `proposal_id` INTEGER,\
+            `event` TEXT,\
+            `message` TEXT,\
+            `priority` INTEGER,\
+            `state` INTEGER NOT NULL DEFAULT 0,\
+            `attempts` INTEGER NOT NULL DEFAULT 0,\
+            `created` INTEGER,\
+            `updated` INTEGER\
+        );\
+        CREATE INDEX IF NOT EXISTS `outbox_state` ON `outbox` (`state`);',
+        # 3 - Indexes for the subscribers and watchers, one watchlist entry per user and proposal
+        'DELETE FROM watchlist WHERE id NOT IN (SELECT MIN(id) FROM watchlist GROUP BY user_id, proposal_id);\
+        CREATE UNIQUE INDEX IF NOT EXISTS `watchlist_user_proposal` ON `watchlist` (`user_id`, `proposal_id`);\
+        CREATE INDEX IF NOT EXISTS `watchlist_proposal` ON `watchlist` (`proposal_id`);\
+        CREATE INDEX IF NOT EXISTS `users_subscription` ON `users` (`subscription`);',
+        # 4 - Broadcast jobs, :cursor is the last user id the message was queued for
+        'CREATE TABLE IF NOT EXISTS "broadcasts" (\
+            `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,\
+            `message` TEXT,\
+            `cursor` INTEGER NOT NULL DEFAULT 0,\
+            `sent` INTEGER NOT NULL DEFAULT 0,\
+            `failed` INTEGER NOT NULL DEFAULT 0,\
+            `state` INTEGER NOT NULL DEFAULT 0,\
+            `created` INTEGER,\
+            `updated` INTEGER\
+        );',
+        # 5 - Active users
+        'CREATE INDEX IF NOT EXISTS `users_last_activity` ON `users` (`last_activity`);',
+    ]
+
+    def __init__(self, dburi, pragmas = None):
+
+        self.connection = util.ThreadedSQLite(dburi, pragmas)
+
+        migrate(self.connection, self.migrations, "bot")
+
+        # In memory audience for the notifications, the ids of the
+        # subscribed users and proposalId => ids of the watching users.
+        self.audienceLock = threading.Lock()
+        self.subscribers = set()
+        self.watchers = {}
+        # Ids of all users in the database
+        self.knownUsers = set()
+        # userId => time of the last activity not yet written
+        self.activity = {}
+        self.activityWritten = time.time()
+
+        self.loadAudience()
+
+    ######
+    # Load the users, the subscribers and the watchers of all proposals
+    # into memory.
+    ######
+    def loadAudience(self):
+
+        with self.connection.read() as db:
+
+            db.cursor.execute("SELECT id, subscription FROM users")
+            users = db.cursor.fetchall()
+
+            db.cursor.execute("SELECT user_id, proposal_id FROM watchlist")
+            watchlist = db.cursor.fetchall()
 
-        self.connection = util.ThreadedSQLite(dburi)
+        knownUsers = set(x['id'] for x in users)
+        subscribers = set(x['id'] for x in users if x['subscription'] == 1)
+        watchers = {}
 
-        if self.isEmpty():
-            self.reset()
+        for entry in watchlist:
+            watchers.setdefault(entry['proposal_id'], set()).add(entry['user_id'])
 
-    def isEmpty(self):
+        with self.audienceLock:
+            self.knownUsers = knownUsers
+            self.subscribers = subscribers
+            self.watchers = watchers
 
-        tables = []
+        logger.info("loadAudience: {} users, {} subscribers, {} watched proposals".format(len(knownUsers), len(subscribers), len(watchers)))
 
-        with self.connection as db:
+    ######
+    # Check if the user with :userId is in the database, without a query.
+    ######
+    def isKnownUser(self, userId):
 
-            db.cursor.execute("SELECT name FROM sqlite_master")
+        if not util.isInt(userId):
+            return False
 
-            tables = db.cursor.fetchall()
+        with self.audienceLock:
+            return int(userId) in self.knownUsers
 
-        return len(tables) == 0
+    ######
+    # Returns the ids of all subscribed users.
+    ######
+    def getSubscribers(self):
 
-    def addUser(self, userId, userName):
+        with self.audienceLock:
+            return list(self.subscribers)
 
-        user = None
+    ######
+    # Returns the ids of all users watching the proposal with :proposalId.
+    ######
+    def getWatchers(self, proposalId):
+
+        with self.audienceLock:
+            return list(self.watchers.get(int(proposalId), ()))
+
+    ######
+    # Returns the number of users, subscribers and watchlist entries
+    # without a query.
+    ######
+    def getAudienceCounts(self):
+
+        with self.audienceLock:
+            return {'users': len(self.knownUsers),
+                    'subscribers': len(self.subscribers),
+                    'watchlist': sum(len(x) for x in self.watchers.values())}
+
+    def countWatchers(self, proposalId):
+
+        with self.audienceLock:
+            return len(self.watchers.get(int(proposalId), ()))
+
+    ######
+    # Remember the activity of the user with :userId. The times get
+    # written in batches of :batch users or after :interval seconds.
+    ######
+    def touchUser(self, userId, batch = 100, interval = 60):
+
+        if not util.isInt(userId):
+            return
+
+        with self.audienceLock:
+            self.activity[int(userId)] = int(time.time())
+            flush = len(self.activity) >= batch or time.time() - self.activityWritten >= interval
+
+        if flush:
+            self.writeActivity()
+
+    def writeActivity(self):
+
+        with self.audienceLock:
+            activity, self.activity = self.activity, {}
+            self.activityWritten = time.time()
+
+        if not len(activity):
+            return
 
         try:
 
-            with self.connection as db:
+            with self.connection.write() as db:
 
-                logger.debug("addUser: New user {} {}".format(userId,userName))
+                db.cursor.executemany("UPDATE users SET last_activity=? WHERE id=?", [(x[1], x[0]) for x in activity.items()])
 
-                db.cursor.execute("INSERT INTO users( id, name, subscription ) values( ?, ?, 1 )", ( userId, userName ))
+        except Exception as e:
+            logger.error("writeActivity", exc_info=e)
 
-                user = db.cursor.lastrowid
-        except:
-            pass
+            # Keep the newer times of the users touched meanwhile
+            with self.audienceLock:
+                activity.update(self.activity)
+                self.activity = activity
 
-        return user
+    ######
+    # Number of users active within the last :seconds.
+    ######
+    def countActiveUsers(self, seconds):
+
+        self.writeActivity()
+
+        with self.connection.read() as db:
+
+            db.cursor.execute("SELECT COUNT(*) FROM users WHERE last_activity>=?", [int(time.time()) - seconds])
+
+            return db.cursor.fetchone()[0]
+
+    ######
+    # Add the user with :userId as subscriber if it's not yet in the
+    # database. :active sets the activity of the user. Returns True if the
+    # user was added.
+    ######
+    def addUser(self, userId, userName, active = True):
+
+        added = False
+
+        try:
+
+            with self.connection.write() as db:
+
+                db.cursor.execute("INSERT OR IGNORE INTO users( id, name, subscription, last_activity ) values( ?, ?, 1, ? )", ( userId, userName, int(time.time()) if active else None ))
+
+                added = db.cursor.rowcount > 0
+
+        except Exception as e:
+            logger.error("addUser", exc_info=e)
+            return False
+
+        with self.audienceLock:
+
+            self.knownUsers.add(int(userId))
+
+            if added:
+                logger.debug("addUser: New user {} {}".format(userId,userName))
+                self.subscribers.add(int(userId))
+
+        return added
 
     def getUser(self, userId):
 
         user = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
 
             db.cursor.execute("SELECT * FROM users WHERE id=?",[userId])
 
@@ -69,7 +302,7 @@ class BotDatabase(object):
 
         users = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
 
             db.cursor.execute("SELECT * FROM users")
 
@@ -77,11 +310,34 @@ class BotDatabase(object):
 
         return users
 
+    ######
+    # Returns up to :limit user ids above :afterId in ascending order. Used
+    # to page through all users without loading them at once.
+    ######
+    def getUserIds(self, afterId = 0, limit = 500):
+
+        with self.connection.read() as db:
+
+            db.cursor.execute("SELECT id FROM users WHERE id>? ORDER BY id LIMIT ?", (afterId, limit))
+
+            return [x['id'] for x in db.cursor.fetchall()]
+
+    def countUsers(self, afterId = None):
+
+        with self.connection.read() as db:
+
+            if afterId is None:
+                db.cursor.execute("SELECT COUNT(*) FROM users")
+            else:
+                db.cursor.execute("SELECT COUNT(*) FROM users WHERE id>?", [afterId])
+
+            return db.cursor.fetchone()[0]
+
     def getSubscriptions(self):
 
         users = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
 
             db.cursor.execute("SELECT * FROM users WHERE subscription=1")
 
@@ -91,23 +347,36 @@ class BotDatabase(object):
 
     def updateSubscription(self, userId, state):
 
-        with self.connection as db:
+        with self.connection.write() as db:
 
             db.cursor.execute("UPDATE users SET subscription = ? WHERE id=?",(state,userId))
 
+            updated = db.cursor.rowcount
+
+        if updated:
+            with self.audienceLock:
+                if state:
+                    self.subscribers.add(int(userId))
+                else:
+                    self.subscribers.discard(int(userId))
+
     def deleteUser(self, userId):
 
-        with self.connection as db:
+        with self.connection.write() as db:
 
             db.cursor.execute("DELETE FROM users WHERE id=?",[userId])
 
+        with self.audienceLock:
+            self.knownUsers.discard(int(userId))
+            self.subscribers.discard(int(userId))
+
     def getWatchlist(self, userId = None, proposalId = None):
 
         watchlist = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
             if userId and proposalId:
-                db.cursor.execute("SELECT * FROM watchlist WHERE user_id=? AND proposal_id=?",[userId])
+                db.cursor.execute("SELECT * FROM watchlist WHERE user_id=? AND proposal_id=?",[userId, proposalId])
             elif userId and not proposalId:
                 db.cursor.execute("SELECT * FROM watchlist WHERE user_id=?",[userId])
             elif not userId and proposalId:
@@ -125,11 +394,11 @@ class BotDatabase(object):
 
         try:
 
-            with self.connection as db:
+            with self.connection.write() as db:
 
                 logger.debug("addToWatchlist: {} - {}".format(userId,proposalId))
 
-                db.cursor.execute("INSERT INTO watchlist( user_id, proposal_id ) values( ?, ? )", ( userId, proposalId ))
+                db.cursor.execute("INSERT OR IGNORE INTO watchlist( user_id, proposal_id ) values( ?, ? )", ( userId, proposalId ))
 
                 added = db.cursor.rowcount
 
@@ -137,6 +406,10 @@ class BotDatabase(object):
             logger.error("addToWatchlist", exc_info=e)
             pass
 
+        if added:
+            with self.audienceLock:
+                self.watchers.setdefault(int(proposalId), set()).add(int(userId))
+
         return added
 
     def removeFromWatchlist(self, userId, proposalId = None):
@@ -145,7 +418,7 @@ class BotDatabase(object):
 
         try:
 
-            with self.connection as db:
+            with self.connection.write() as db:
                 if proposalId:
                     db.cursor.execute("DELETE FROM watchlist WHERE user_id=? AND proposal_id=?",(userId, proposalId))
                 else:
@@ -157,26 +430,149 @@ class BotDatabase(object):
             logger.error("removeFromWatchlist", exc_info=e)
             pass
 
+        if removed:
+            with self.audienceLock:
+
+                proposalIds = [int(proposalId)] if proposalId else list(self.watchers.keys())
+
+                for watched in proposalIds:
+
+                    watchers = self.watchers.get(watched)
+
+                    if watchers is not None:
+
+                        watchers.discard(int(userId))
+
+                        if not len(watchers):
+                            del self.watchers[watched]
+
         return removed
 
-    def reset(self):
+    def addBroadcast(self, message):
 
-        sql = 'BEGIN TRANSACTION;\
-        CREATE TABLE "users" (\
-        	`id`	INTEGER NOT NULL PRIMARY KEY,\
-        	`name`	INTEGER,\
-        	`subscription`	INTEGER,\
-            `last_activity`	INTEGER\
-        );\
-        CREATE TABLE "watchlist" (\
-        	`id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,\
-            `user_id` INTEGER,\
-        	`proposal_id` INTEGER\
-        );\
-        COMMIT;'
+        now = int(time.time())
+
+        with self.connection.write() as db:
+
+            db.cursor.execute("INSERT INTO broadcasts( message, state, created, updated ) values( ?, ?, ?, ? )", (message, broadcastRunning, now, now))
+
+            return db.cursor.lastrowid
+
+    ######
+    # Returns the broadcast with :broadcastId or the latest one.
+    ######
+    def getBroadcast(self, broadcastId = None):
+
+        with self.connection.read() as db:
+
+            if broadcastId is None:
+                db.cursor.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+            else:
+                db.cursor.execute("SELECT * FROM broadcasts WHERE id=?", [broadcastId])
+
+            return db.cursor.fetchone()
+
+    def updateBroadcast(self, broadcastId, cursor, sent, failed, state):
+
+        try:
+
+            with self.connection.write() as db:
+
+                db.cursor.execute("UPDATE broadcasts SET cursor=?, sent=?, failed=?, state=?, updated=? WHERE id=?",
+                                  (cursor, sent, failed, state, int(time.time()), broadcastId))
+
+        except Exception as e:
+            logger.error("updateBroadcast", exc_info=e)
+            return False
+
+        return True
+
+    ######
+    # Store planned notifications in one transaction. :entries is a list of
+    # (key, userId, proposalId, event, message, priority) tuples. Entries with
+    # an already known key get skipped. Returns the added entries or None
+    # if the entries could not be stored.
+    ######
+    def addToOutbox(self, entries):
+
+        added = []
+        now = int(time.time())
+
+        try:
+
+            with self.connection.write() as db:
+
+                for entry in entries:
+
+                    db.cursor.execute("INSERT OR IGNORE INTO outbox( key, user_id, proposal_id, event, message, priority, state, created, updated )\
+                                       values( ?, ?, ?, ?, ?, ?, ?, ?, ? )", tuple(entry) + (outboxPending, now, now))
+
+                    if db.cursor.rowcount:
+                        added.append(entry)
+
+        except Exception as e:
+            logger.error("addToOutbox", exc_info=e)
+            return None
+
+        logger.debug("addToOutbox: {} added, {} known".format(len(added), len(entries) - len(added)))
+
+        return added
+
+    ######
+    # Returns up to :limit pending notifications with an id above :afterId.
+    ######
+    def getPendingOutbox(self, afterId = 0, limit = 500):
+
+        entries = None
+
+        with self.connection.read() as db:
+
+            db.cursor.execute("SELECT * FROM outbox WHERE state=? AND id>? ORDER BY id LIMIT ?", (outboxPending, afterId, limit))
 
-        with self.connection as db:
-            db.cursor.executescript(sql)
+            entries = db.cursor.fetchall()
+
+        return entries
+
+    ######
+    # Set the delivery state for a batch of :keys.
+    ######
+    def updateOutbox(self, keys, state):
+
+        now = int(time.time())
+
+        try:
+
+            with self.connection.write() as db:
+
+                db.cursor.executemany("UPDATE outbox SET state=?, attempts=attempts+1, updated=? WHERE key=?", [(state, now, key) for key in keys])
+
+        except Exception as e:
+            logger.error("updateOutbox", exc_info=e)
+            return False
+
+        return True
+
+    ######
+    # Returns the number of outbox entries by their state.
+    ######
+    def countOutbox(self):
+
+        with self.connection.read() as db:
+
+            db.cursor.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state")
+
+            return dict((x[0], x[1]) for x in db.cursor.fetchall())
+
+    ######
+    # Delete delivered or failed notifications older than :seconds.
+    ######
+    def cleanOutbox(self, seconds):
+
+        with self.connection.write() as db:
+
+            db.cursor.execute("DELETE FROM outbox WHERE state!=? AND updated<?", (outboxPending, int(time.time()) - seconds))
+
+            return db.cursor.rowcount
 
 
 #####
@@ -188,91 +584,121 @@ class BotDatabase(object):
 
 class ProposalDatabase(object):
 
-    def __init__(self, dburi):
-
-        self.connection = util.ThreadedSQLite(dburi)
-
-        if self.isEmpty():
-            self.reset()
-
-    def isEmpty(self):
-
-        tables = []
-
-        with self.connection as db:
+    ######
+    # Schema migrations, see migrate(). Never change an existing entry,
+    # append a new one instead.
+    ######
+    migrations = [
+        # 1 - Proposals of the voting portal
+        'CREATE TABLE IF NOT EXISTS "proposals" (\
+            `proposalId` INTEGER NOT NULL PRIMARY KEY,\
+            `proposalKey` TEXT,\
+            `title` TEXT,\
+            `url` TEXT,\
+            `summary` TEXT,\
+            `owner` TEXT,\
+            `amountSmart` REAL,\
+            `amountUSD` REAL,\
+            `installment` INTEGER,\
+            `createdDate` TEXT,\
+            `votingDeadline` TEXT,\
+            `status` TEXT,\
+            `voteYes` REAL,\
+            `voteNo` REAL,\
+            `voteAbstain` REAL,\
+            `percentYes` REAL,\
+            `percentNo` REAL,\
+            `percentAbstain` REAL,\
+            `currentStatus` TEXT,\
+            `categoryTitle` TEXT,\
+            `approval` INTEGER,\
+            `reminder` INTEGER,\
+            `twitter` INTEGER,\
+            `reddit` INTEGER,\
+            `gab` INTEGER,\
+            `discord` INTEGER\
+        );',
+    ]
 
-            db.cursor.execute("SELECT name FROM sqlite_master")
+    def __init__(self, dburi, pragmas = None):
 
-            tables = db.cursor.fetchall()
+        self.connection = util.ThreadedSQLite(dburi, pragmas)
 
-        return len(tables) == 0
+        migrate(self.connection, self.migrations, "proposals")
 
     def raw(self, query):
 
-        with self.connection as db:
+        with self.connection.read() as db:
             db.cursor.execute(query)
             return db.cursor.fetchall()
 
         return None
 
+    ######
+    # Values for the insert query of :proposal. The publishing states always
+    # start unpublished.
+    ######
+    @staticmethod
+    def insertValues(proposal):
+        return (proposal.proposalId,
+                proposal.proposalKey,
+                proposal.title,
+                proposal.url,
+                proposal.summary,
+                proposal.owner,
+                proposal.amountSmart,
+                proposal.amountUSD,
+                proposal.installment,
+                proposal.createdDate,
+                proposal.votingDeadline,
+                proposal.status,
+                proposal.voteYes,
+                proposal.voteNo,
+                proposal.voteAbstain,
+                proposal.percentYes,
+                proposal.percentNo,
+                proposal.percentAbstain,
+                proposal.currentStatus,
+                proposal.categoryTitle,
+                proposal.approval,
+                proposal.reminder)
+
+    insertQuery = "INSERT INTO proposals(\
+                   proposalId,\
+                   proposalKey, \
+                   title,\
+                   url,\
+                   summary,\
+                   owner,\
+                   amountSmart,\
+                   amountUSD,\
+                   installment,\
+                   createdDate,\
+                   votingDeadline,\
+                   status,\
+                   voteYes,\
+                   voteNo,\
+                   voteAbstain,\
+                   percentYes,\
+                   percentNo,\
+                   percentAbstain,\
+                   currentStatus,\
+                   categoryTitle,\
+                   approval,\
+                   reminder,\
+                   twitter,\
+                   reddit,\
+                   gab,\
+                   discord) \
+                   values( ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,0,0,0,0 )"
+
     def addProposal(self, proposal):
 
         try:
 
-            with self.connection as db:
-                query = "INSERT INTO proposals(\
-                        proposalId,\
-                        proposalKey, \
-                        title,\
-                        url,\
-                        summary,\
-                        owner,\
-                        amountSmart,\
-                        amountUSD,\
-                        installment,\
-                        createdDate,\
-                        votingDeadline,\
-                        status,\
-                        voteYes,\
-                        voteNo,\
-                        voteAbstain,\
-                        percentYes,\
-                        percentNo,\
-                        percentAbstain,\
-                        currentStatus,\
-                        categoryTitle,\
-                        approval,\
-                        reminder,\
-                        twitter,\
-                        reddit,\
-                        gab,\
-                        discord) \
-                        values( ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,0,0,0,0 )"
+            with self.connection.write() as db:
 
-                db.cursor.execute(query, (
-                                  proposal.proposalId,
-                                  proposal.proposalKey,
-                                  proposal.title,
-                                  proposal.url,
-                                  proposal.summary,
-                                  proposal.owner,
-                                  proposal.amountSmart,
-                                  proposal.amountUSD,
-                                  proposal.installment,
-                                  proposal.createdDate,
-                                  proposal.votingDeadline,
-                                  proposal.status,
-                                  proposal.voteYes,
-                                  proposal.voteNo,
-                                  proposal.voteAbstain,
-                                  proposal.percentYes,
-                                  proposal.percentNo,
-                                  proposal.percentAbstain,
-                                  proposal.currentStatus,
-                                  proposal.categoryTitle,
-                                  proposal.approval,
-                                  proposal.reminder
-                                  ))
+                db.cursor.execute(self.insertQuery, self.insertValues(proposal))
 
                 return db.cursor.lastrowid
 
@@ -285,7 +711,7 @@ class ProposalDatabase(object):
 
         try:
 
-            with self.connection as db:
+            with self.connection.write() as db:
                 query = "UPDATE proposals SET \
                         proposalKey=?, \
                         title=?,\
@@ -350,11 +776,48 @@ class ProposalDatabase(object):
 
         return None
 
+    ######
+    # Insert the :added proposals and write the changed fields of the
+    # :updated proposals in one transaction. Updates with the same set
+    # of changed fields get batched into one statement.
+    ######
+    def storeProposals(self, added = [], updated = []):
+
+        groups = {}
+
+        for proposal in updated:
+
+            columns = tuple(sorted(proposal.dirty - {'proposalId'}))
+
+            if len(columns):
+                groups.setdefault(columns, []).append(proposal)
+
+        try:
+
+            with self.connection.write() as db:
+
+                if len(added):
+                    db.cursor.executemany(self.insertQuery, [self.insertValues(x) for x in added])
+
+                for columns, proposals in groups.items():
+
+                    query = "UPDATE proposals SET {} WHERE proposalId=?".format(",".join(["{}=?".format(x) for x in columns]))
+                    values = [[getattr(x, column) for column in columns] + [x.proposalId] for x in proposals]
+
+                    db.cursor.executemany(query, values)
+
+            return True
+
+        except Exception as e:
+            logger.error("storeProposals ", exc_info=e)
+
+        return False
+
     def getProposals(self):
 
         proposals = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
             db.cursor.execute("SELECT * FROM proposals order by proposalId")
             proposals = db.cursor.fetchall()
 
@@ -364,46 +827,52 @@ class ProposalDatabase(object):
 
         proposal = None
 
-        with self.connection as db:
+        with self.connection.read() as db:
 
             db.cursor.execute("SELECT * FROM proposals where proposalId=? order by proposalId",[proposalId])
             proposal = db.cursor.fetchone()
 
         return proposal
 
-    def reset(self):
 
-        sql = '\
-        BEGIN TRANSACTION;\
-        CREATE TABLE "proposals" (\
-        	`proposalId` INTEGER NOT NULL PRIMARY KEY,\
-            `proposalKey` TEXT,\
-        	`title`	TEXT,\
-        	`url` TEXT,\
-        	`summary`	TEXT,\
-        	`owner` TEXT,\
-        	`amountSmart` REAL,\
-        	`amountUSD`	REAL,\
-        	`installment`	INTEGER,\
-            `createdDate` TEXT,\
-            `votingDeadline` TEXT,\
-            `status` TEXT,\
-            `voteYes` REAL,\
-            `voteNo` REAL,\
-            `voteAbstain` REAL,\
-            `percentYes` REAL,\
-            `percentNo` REAL,\
-            `percentAbstain` REAL,\
-            `currentStatus` TEXT,\
-            `categoryTitle` TEXT,\
-            `approval` INTEGER,\
-            `reminder` INTEGER,\
-            `twitter` INTEGER,\
-            `reddit` INTEGER,\
-            `gab` INTEGER,\
-            `discord` INTEGER\
-        );\
-        COMMIT;'
+#####
+#
+# Awaitable access to a database for coroutines. All calls run on one
+# dedicated thread so the event loop never waits for SQLite.
+#
+#  await asyncDatabase.getUser(userId)
+#  await asyncDatabase.run(commands.add, bot, message, args)
+#
+#####
+
+class AsyncDatabase(object):
+
+    def __init__(self, database):
+
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+
+    ######
+    # Run :function with the given arguments on the database thread.
+    ######
+    async def run(self, function, *args, **kwargs):
+
+        loop = asyncio.get_event_loop()
+
+        with asyncSeconds.time(call=function.__name__):
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def __getattr__(self, name):
+
+        attribute = getattr(self.database, name)
+
+        if not callable(attribute):
+            return attribute
+
+        def method(*args, **kwargs):
+            return self.run(attribute, *args, **kwargs)
+
+        return method
 
-        with self.connection as db:
-            db.cursor.executescript(sql)
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -7,31 +7,593 @@ import json
 import discord
 import asyncio
 import uuid
+import itertools
+import hashlib
+import functools
+import inspect
 
 from fuzzywuzzy import process as fuzzy
 
 from src import util
 from src import messages
+from src import database
+from src import metrics
 from src import commands as commandhandler
 
 from src.socialmedia import PublishResult
 
 logger = logging.getLogger("bot")
 
+messagesSent = metrics.counter('bot_messages_total', 'Messages sent by sendMessage by their result', ['result'])
+rateLimited = metrics.counter('bot_rate_limited_total', 'Rate limited message requests')
+notificationSeconds = metrics.histogram('bot_notification_latency_seconds', 'Time from queueing a notification until its delivery')
+
+####
+# List of available commands
+# Public = 0
+# DM-Only = 1
+# Admin only = 2
+####
+commandAccess = {
+            # DM Only
+            'subscribe':1,'unsubscribe':1,'add':1,'remove':1,'watchlist':1,
+            # Public
+            'help':0,'open':0,'latest':0,'passing':0,'failing':0, 'detail':0,'ending':0,
+            # Admin commands
+            'stats':2, 'broadcast':2, 'publish':2, 'new':2,
+}
+
+# Prefixes with at least 3 characters which match only one command,
+# like "sub" => "subscribe" or "watch" => "watchlist".
+commandAliases = {}
+
+for name in commandAccess:
+    for length in range(3, len(name)):
+        commandAliases.setdefault(name[:length], set()).add(name)
+
+commandAliases = {prefix: names.pop() for prefix, names in commandAliases.items() if len(names) == 1}
+
+######
+# Fuzzy match for misspelled commands. The results get cached since the
+# same typos come up again and again.
+######
+@functools.lru_cache(maxsize=512)
+def fuzzyCommand(command):
+
+    choices = fuzzy.extract(command,commandAccess.keys(),limit=2)
+
+    if choices[0][1] == choices[1][1] or choices[0][1] < 60:
+        logger.debug('Invalid fuzzy result {}'.format(choices))
+        return 'unknown'
+
+    return choices[0][0]
+
+######
+# Resolve the typed :command to one of the available commands or 'unknown'.
+######
+def resolveCommand(command):
+
+    if command in commandAccess:
+        return command
+
+    if command in commandAliases:
+        return commandAliases[command]
+
+    return fuzzyCommand(command)
+
+######
+#
+# Index of the members of all servers by their userId. Allows to find
+# the member object of a user without walking all members.
+#
+#####
+
+class MemberIndex(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # userId => {serverId => member}
+        self.members = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def build(self, members):
+
+        index = {}
+
+        for member in members:
+            index.setdefault(int(member.id), {})[member.server.id] = member
+
+        with self.lock:
+            self.members = index
+
+    def add(self, member):
+
+        with self.lock:
+            self.members.setdefault(int(member.id), {})[member.server.id] = member
+
+    def remove(self, member):
+
+        with self.lock:
+
+            servers = self.members.get(int(member.id))
+
+            if servers is None:
+                return
+
+            servers.pop(member.server.id, None)
+
+            if not len(servers):
+                del self.members[int(member.id)]
+
+    def find(self, userId):
+
+        with self.lock:
+
+            servers = self.members.get(int(userId))
+
+            if servers:
+                return next(iter(servers.values()))
+
+        return None
+
+######
+#
+# Token bucket rate limiter. Allows bursts of :capacity requests and
+# refills with :rate tokens per second.
+#
+#####
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    ######
+    # Take a token if available. Returns 0 on success or the seconds to
+    # wait until the next try.
+    ######
+    def take(self):
+
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+
+        while True:
+
+            wait = self.take()
+
+            if not wait:
+                return
+
+            await asyncio.sleep(wait)
+
+# Notification priorities, lower gets delivered first
+priorityHigh = 0 # New/ending/ended proposal notices
+priorityNormal = 1 # Admin messages
+priorityLow = 2 # Watchlist updates
+
+######
+#
+# Queue for the outgoing notifications. Delivers the messages ordered by
+# their priority with a bounded number of workers. The rate limits get
+# applied by sendMessage of the bot.
+#
+# Notifications for users can be coalesced: all of them which arrive for
+# the same user within the coalesce window get merged into one message.
+#
+# Messages with outbox keys get their delivery state written back to
+# the outbox in batches.
+#
+#####
+
+class NotificationDispatcher(object):
+
+    # Write the outbox states after this many deliveries or seconds
+    outboxBatch = 100
+    outboxInterval = 1
+    # Seconds between the removals of old notifications from the outbox
+    outboxCleanInterval = 60 * 60
+
+    def __init__(self, bot, workers = 4, coalesceWindow = 0):
+
+        self.bot = bot
+        self.workers = workers
+        self.coalesceWindow = coalesceWindow
+        self.queue = None
+        # receiver.id => messages waiting for the end of the coalesce window
+        self.coalescing = {}
+        # Outbox keys of delivered/failed messages not yet written
+        self.sentKeys = []
+        self.failedKeys = []
+        # Keeps the order of messages with the same priority
+        self.counter = itertools.count()
+        # Messages queued before the loop was running
+        self.backlog = []
+
+        self.delivered = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.latencyTotal = 0
+        self.latencyMax = 0
+
+    ######
+    # Create the queue and the workers, needs to be called on the event loop.
+    ######
+    def start(self):
+
+        if self.queue is not None:
+            return
+
+        self.queue = asyncio.PriorityQueue()
+
+        for i in range(self.workers):
+            asyncio.ensure_future(self.worker())
+
+        asyncio.ensure_future(self.outboxWriter())
+
+        for args in self.backlog:
+            self.add(*args)
+
+        self.backlog = []
+
+    ######
+    # Queue :text for :receiver. Can be called from any thread. :keys are
+    # the outbox keys of the message, :coalesce allows to merge it with
+    # other messages for the same receiver. :done gets called on the event
+    # loop with the delivery result.
+    ######
+    def put(self, receiver, text, priority = priorityNormal, keys = None, coalesce = False, done = None):
+
+        args = (receiver, text, priority, keys if keys else [], [done] if done else [], coalesce, time.monotonic())
+
+        if self.queue is None:
+            self.backlog.append(args)
+        elif threading.current_thread() is self.bot.loopThread:
+            self.add(*args)
+        else:
+            self.bot.client.loop.call_soon_threadsafe(self.add, *args)
+
+    def add(self, receiver, text, priority, keys, done, coalesce, queued):
+
+        if not coalesce or not self.coalesceWindow:
+            self.queue.put_nowait((priority, next(self.counter), queued, receiver, [text], keys, done))
+            return
+
+        pending = self.coalescing.get(receiver.id)
+
+        if pending is None:
+            pending = {'receiver': receiver, 'texts': [], 'keys': [], 'done': [], 'priority': priority, 'queued': queued}
+            self.coalescing[receiver.id] = pending
+            self.bot.client.loop.call_later(self.coalesceWindow, self.release, receiver.id)
+        else:
+            self.coalesced += 1
+
+        pending['texts'].append(text)
+        pending['keys'].extend(keys)
+        pending['done'].extend(done)
+        pending['priority'] = min(pending['priority'], priority)
+
+    ######
+    # Queue the coalesced messages of the receiver with :receiverId.
+    ######
+    def release(self, receiverId):
+
+        pending = self.coalescing.pop(receiverId, None)
+
+        if pending:
+            self.queue.put_nowait((pending['priority'], next(self.counter), pending['queued'],
+                                   pending['receiver'], pending['texts'], pending['keys'], pending['done']))
+
+    def depth(self):
+        return (self.queue.qsize() if self.queue else 0) + len(self.backlog) + len(self.coalescing)
+
+    def stats(self):
+
+        count = self.delivered + self.failed
+
+        return {'depth': self.depth(),
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+                'latencyAvg': self.latencyTotal / count if count else 0,
+                'latencyMax': self.latencyMax}
+
+    ######
+    # Remember the delivery state of the outbox entry :key. Can be called
+    # from any thread.
+    ######
+    def finished(self, key, success):
+
+        if success:
+            self.sentKeys.append(key)
+        else:
+            self.failedKeys.append(key)
+
+    async def writeOutbox(self):
+
+        sent, self.sentKeys = self.sentKeys, []
+        failed, self.failedKeys = self.failedKeys, []
+
+        if len(sent) and not await self.bot.asyncDatabase.updateOutbox(sent, database.outboxSent):
+            self.sentKeys.extend(sent)
+
+        if len(failed) and not await self.bot.asyncDatabase.updateOutbox(failed, database.outboxFailed):
+            self.failedKeys.extend(failed)
+
+    async def cleanOutbox(self):
+
+        cleaned = await self.bot.asyncDatabase.cleanOutbox(self.bot.outboxRetention)
+
+        if cleaned:
+            logger.info("Removed {} old notifications from the outbox".format(cleaned))
+
+    async def outboxWriter(self):
+
+        cleaned = None
+
+        while True:
+
+            await asyncio.sleep(self.outboxInterval)
+
+            try:
+                await self.writeOutbox()
+
+                if cleaned is None or time.monotonic() - cleaned >= self.outboxCleanInterval:
+                    cleaned = time.monotonic()
+                    await self.cleanOutbox()
+
+            except Exception as e:
+                logger.error("outboxWriter", exc_info=e)
+
+    async def worker(self):
+
+        while True:
+
+            priority, number, queued, receiver, texts, keys, done = await self.queue.get()
+
+            # Merged messages get separated by an empty line, sendMessage
+            # splits them again if they exceed the message size limit.
+            text = "\n\n".join([x.strip('\n') for x in texts]) if len(texts) > 1 else texts[0]
+
+            try:
+                success = await self.bot.sendMessage(receiver, text)
+            except Exception as e:
+                logger.error("dispatcher", exc_info=e)
+                success = False
+
+            latency = time.monotonic() - queued
+
+            notificationSeconds.observe(latency)
+
+            self.latencyTotal += latency
+            self.latencyMax = max(self.latencyMax, latency)
+
+            if success:
+                self.delivered += 1
+            else:
+                self.failed += 1
+                logger.warning("dispatcher - delivery failed {}".format(receiver))
+
+            for key in keys:
+                self.finished(key, success)
+
+            for callback in done:
+                try:
+                    callback(success)
+                except Exception as e:
+                    logger.error("dispatcher - done callback", exc_info=e)
+
+            if len(self.sentKeys) + len(self.failedKeys) >= self.outboxBatch:
+                await self.writeOutbox()
+
+            self.queue.task_done()
+
+######
+#
+# Admin broadcast running in the background. Pages through the users by
+# their id and queues the message for at most one page of users at a
+# time. The deliveries go through the outbox and the dispatcher like all
+# other notifications, the progress gets stored after each page so a
+# cancelled or interrupted broadcast can be resumed.
+#
+#####
+
+class BroadcastJob(object):
+
+    pageSize = 100
+    # Seconds between the progress reports to the admin
+    reportInterval = 60
+    # Seconds to wait before a page gets retried if the outbox failed
+    retryInterval = 30
+
+    def __init__(self, bot, admin, broadcast):
+
+        self.bot = bot
+        self.admin = admin
+        self.broadcastId = broadcast['id']
+        self.message = broadcast['message']
+        self.cursor = broadcast['cursor']
+        self.sent = broadcast['sent']
+        self.failed = broadcast['failed']
+        self.state = broadcast['state']
+        # Users not yet queued
+        self.pending = 0
+        # Queued, not yet delivered messages
+        self.inflight = 0
+        self.cancelled = False
+        self.space = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.state = database.broadcastRunning
+        self.task = asyncio.ensure_future(self.run())
+
+    def cancel(self):
+        self.cancelled = True
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def remaining(self):
+        return self.pending + self.inflight
+
+    def status(self):
+
+        states = {database.broadcastRunning: 'running', database.broadcastDone: 'done', database.broadcastCancelled: 'cancelled'}
+
+        response = "<u><b>Broadcast #{}<b><u>\n\n".format(self.broadcastId)
+        response += "State: <b>{}<b>\n".format("cancelling" if self.cancelled and self.state == database.broadcastRunning else states[self.state])
+        response += "Sent: <b>{}<b>\n".format(self.sent)
+        response += "Failed: <b>{}<b>\n".format(self.failed)
+        response += "Remaining: <b>{}<b>\n".format(self.remaining())
+
+        return messages.markdown(response, self.bot.messenger)
+
+    def report(self):
+        self.bot.dispatcher.put(self.admin, self.status(), priorityNormal)
+
+    def delivered(self, success):
+
+        self.inflight -= 1
+
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+        self.space.set()
+
+    ######
+    # Wait until not more than :inflight messages are queued.
+    ######
+    async def wait(self, inflight):
+
+        while self.inflight > inflight:
+            self.space.clear()
+            await self.space.wait()
+
+    async def reporter(self):
+
+        while True:
+            await asyncio.sleep(self.reportInterval)
+            self.report()
+
+    async def run(self):
+
+        reporter = asyncio.ensure_future(self.reporter())
+
+        try:
+
+            self.pending = await self.bot.asyncDatabase.countUsers(self.cursor)
+
+            while not self.cancelled:
+
+                # Keep at most one and a half pages in the queue
+                await self.wait(self.pageSize // 2)
+
+                if self.cancelled:
+                    break
+
+                userIds = await self.bot.asyncDatabase.getUserIds(self.cursor, self.pageSize)
+
+                if not len(userIds):
+                    break
+
+                entries = []
+
+                for userId in userIds:
+                    key = "broadcast:{}:{}".format(self.broadcastId, userId)
+                    entries.append((key, userId, None, 'broadcast', self.message, priorityLow))
+
+                added = await self.bot.asyncDatabase.addToOutbox(entries)
+
+                # Retry the page later, the cursor stays where it is
+                if added is None:
+                    self.bot.adminCB("Outbox error, broadcast #{} retries in {}s".format(self.broadcastId, self.retryInterval))
+                    await asyncio.sleep(self.retryInterval)
+                    continue
+
+                # Already known entries get delivered by resumeOutbox
+                for key, userId, proposalId, event, message, priority in added:
+
+                    member = self.bot.findMember(userId)
+
+                    if member:
+                        self.inflight += 1
+                        self.bot.dispatcher.put(member, message, priority, [key], done=self.delivered)
+                    else:
+                        self.failed += 1
+                        self.bot.dispatcher.finished(key, False)
+
+                self.cursor = userIds[-1]
+                self.pending -= len(userIds)
+
+                await self.bot.asyncDatabase.updateBroadcast(self.broadcastId, self.cursor, self.sent, self.failed, self.state)
+
+            # Let the queued messages finish, also when cancelled
+            await self.wait(0)
+
+            self.state = database.broadcastCancelled if self.cancelled else database.broadcastDone
+
+        except Exception as e:
+            logger.error("broadcast", exc_info=e)
+            self.state = database.broadcastCancelled
+        finally:
+            reporter.cancel()
+
+        await self.bot.asyncDatabase.updateBroadcast(self.broadcastId, self.cursor, self.sent, self.failed, self.state)
+
+        self.report()
+
 class SmartProposalsBotDiscord(object):
 
-    def __init__(self, botToken, admins, password, db, proposals, notifyChannelIds, tweeter, reddit, gab):
+    # Discord allows 50 requests per second globally and 5 messages
+    # per 5 seconds into the same channel.
+    globalRate = 50
+    routeRate = 1
+    routeBurst = 5
+    # Max. number of channel buckets before the idle ones get dropped
+    maxRouteBuckets = 1000
+    # Seconds to keep delivered notifications in the outbox
+    outboxRetention = 7 * 24 * 60 * 60
+
+    def __init__(self, botToken, admins, password, db, proposals, notifyChannelIds, tweeter, reddit, gab, notifyWorkers = 4, coalesceWindow = 0):
 
         # Currently only used for markdown
         self.messenger = "discord"
-
-        self.client = discord.Client()
-        self.client.on_ready = self.on_ready
-        self.client.on_message = self.on_message
+        # Rendered proposal messages
+        self.renderCache = messages.RenderCache()
+
+        # Members of all servers by their userId
+        self.memberIndex = MemberIndex()
+        self.setupClient()
+        # Handlers of the available commands
+        self.setupCommands()
+        # Running admin broadcast
+        self.broadcast = None
         # Create a bot instance for async messaging
         self.token = botToken
         # Set the database of the users/watchlists
         self.database = db
+        # Database access from the coroutines
+        self.asyncDatabase = database.AsyncDatabase(db)
         # Store and setup the proposal handler
         self.proposals = proposals
         self.proposals.proposalPublishedCB = self.proposalPublishedCB
@@ -52,11 +614,23 @@ class SmartProposalsBotDiscord(object):
         self.reddit = reddit
         # Gab manager
         self.gab = gab
+        # Thread which runs the event loop of the client
+        self.loopThread = None
+        # Rate limits for sending messages
+        self.globalBucket = TokenBucket(self.globalRate, self.globalRate)
+        self.routeBuckets = {}
+        # Queue for the notifications
+        self.dispatcher = NotificationDispatcher(self, notifyWorkers, coalesceWindow)
+
+        metrics.gauge('bot_notification_queue', 'Notifications waiting for the delivery', function=self.dispatcher.depth)
+        metrics.gauge('bot_members', 'Indexed members of all servers', function=self.memberIndex.__len__)
 
     def runClient(self):
 
         loop = asyncio.get_event_loop()
 
+        self.loopThread = threading.current_thread()
+
         while True:
 
             try:
@@ -73,10 +647,19 @@ class SmartProposalsBotDiscord(object):
 
             time.sleep(10)
 
-            self.client = discord.Client()
+            self.setupClient()
+
+    def setupClient(self):
 
-            self.client.on_ready = self.on_ready
-            self.client.on_message = self.on_message
+        self.client = discord.Client()
+
+        self.client.on_ready = self.on_ready
+        self.client.on_message = self.on_message
+        self.client.on_member_join = self.on_member_join
+        self.client.on_member_remove = self.on_member_remove
+        self.client.on_member_update = self.on_member_update
+        self.client.on_server_join = self.on_server_join
+        self.client.on_server_remove = self.on_server_remove
 
     ######
     # Starts the bot and block until the programm gets stopped.
@@ -90,7 +673,39 @@ class SmartProposalsBotDiscord(object):
         self.proposals.stop()
 
     ######
-    # Send a message :text to a specific user :user
+    # Schedule the :coroutine on the event loop of the client. Calls from
+    # the loop itself (asyncio poller) create the task directly, calls
+    # from other threads (thread poller) hand it over threadsafe.
+    ######
+    def schedule(self, coroutine):
+
+        if threading.current_thread() is self.loopThread:
+            return asyncio.ensure_future(coroutine, loop=self.client.loop)
+
+        return asyncio.run_coroutine_threadsafe(coroutine, loop=self.client.loop)
+
+    ######
+    # Wait until the global and the channel rate limits allow to send a
+    # message to :receiver.
+    ######
+    async def acquireRateLimit(self, receiver):
+
+        route = self.routeBuckets.get(receiver.id)
+
+        if route is None:
+
+            if len(self.routeBuckets) >= self.maxRouteBuckets:
+                self.routeBuckets = {k: v for k, v in self.routeBuckets.items() if not v.full()}
+
+            route = TokenBucket(self.routeRate, self.routeBurst)
+            self.routeBuckets[receiver.id] = route
+
+        await route.acquire()
+        await self.globalBucket.acquire()
+
+    ######
+    # Send a message :text to a specific user :user. Returns True if all
+    # parts were sent.
     ######
     async def sendMessage(self, user, text, split = '\n'):
 
@@ -100,20 +715,34 @@ class SmartProposalsBotDiscord(object):
 
         try:
             for part in parts:
+
+                # discord.py retries the 429 responses itself
+                await self.acquireRateLimit(user)
                 await self.client.send_message(user, part)
+
         except discord.errors.Forbidden:
             logging.error('sendMessage user blocked the bot')
 
             # Remove the user and the assigned watchlist entires.
-            self.database.removeFromWatchlist(user.id)
-            self.database.deleteUser(user.id)
+            await self.asyncDatabase.removeFromWatchlist(user.id)
+            await self.asyncDatabase.deleteUser(user.id)
 
         except discord.errors.HTTPException as e:
             logging.error('HTTPException', exc_info=e)
+
+            if e.response.status == 429:
+                rateLimited.inc()
+
         except Exception as e:
             logging.error('sendMessage', exc_info=e)
         else:
             logger.info("sendMessage - OK!")
+            messagesSent.inc(result='sent')
+            return True
+
+        messagesSent.inc(result='failed')
+
+        return False
 
     async def on_ready(self):
 
@@ -122,9 +751,20 @@ class SmartProposalsBotDiscord(object):
         logger.info(self.client.user.id)
         logger.info('------')
 
+        self.memberIndex.build(self.client.get_all_members())
+
+        self.dispatcher.start()
+
+        logger.info("Indexed {} members".format(len(self.memberIndex)))
+
         # Initialize/Start the proposal list if its not yet
         if not self.proposals.running:
-            self.proposals.start()
+
+            # Queue the notifications which were not delivered before the
+            # last shutdown.
+            await self.asyncDatabase.run(self.resumeOutbox)
+
+            self.proposals.start(self.client.loop)
 
             # Advise the admin about the start.
             self.adminCB("**Bot started**")
@@ -136,6 +776,28 @@ class SmartProposalsBotDiscord(object):
             # Advise the admin about the start.
             self.adminCB("**Bot reconnected**")
 
+    ######
+    # Discord api coroutines which keep the member index up to date.
+    ######
+    async def on_member_join(self, member):
+        self.memberIndex.add(member)
+
+    async def on_member_remove(self, member):
+        self.memberIndex.remove(member)
+
+    async def on_member_update(self, before, after):
+        self.memberIndex.add(after)
+
+    async def on_server_join(self, server):
+
+        for member in server.members:
+            self.memberIndex.add(member)
+
+    async def on_server_remove(self, server):
+
+        for member in server.members:
+            self.memberIndex.remove(member)
+
     ######
     # Discord api coroutine which gets called when a new message has been
     # received in one of the channels or in a private chat with the bot.
@@ -168,7 +830,7 @@ class SmartProposalsBotDiscord(object):
                 if not mention == self.client.user:
 
                     # Check if the user is already in the databse
-                    result = commandhandler.checkUser(self, mention)
+                    result = await self.asyncDatabase.run(commandhandler.checkUser, self, mention, False)
 
                     if result['response']:
                         await self.sendMessage(mention, result['response'])
@@ -205,7 +867,7 @@ class SmartProposalsBotDiscord(object):
         logger.info("commandHandler - {}, command: {}, args: {}".format(message.author, command, args))
 
         # Check if the user is already in the databse
-        result = commandhandler.checkUser(self, message)
+        result = await self.asyncDatabase.run(commandhandler.checkUser, self, message)
 
         if result['response']:
             await self.sendMessage(message.author, result['response'])
@@ -216,37 +878,16 @@ class SmartProposalsBotDiscord(object):
         # per default assume the message gets back from where it came
         receiver = message.author
 
-        ####
-        # List of available commands
-        # Public = 0
-        # DM-Only = 1
-        # Admin only = 2
-        ####
-        commands = {
-                    # DM Only
-                    'subscribe':1,'unsubscribe':1,'add':1,'remove':1,'watchlist':1,
-                    # Public
-                    'help':0,'open':0,'latest':0,'passing':0,'failing':0, 'detail':0,'ending':0,
-                    # Admin commands
-                    'stats':2, 'broadcast':2, 'publish':2, 'new':2,
-        }
-
-        choices = fuzzy.extract(command,commands.keys(),limit=2)
-
-        if choices[0][1] == choices[1][1] or choices[0][1] < 60:
-            logger.debug('Invalid fuzzy result {}'.format(choices))
-            command = 'unknown'
-        else:
-            command = choices[0][0]
+        command = resolveCommand(command)
 
         # If the command is DM only
-        if command in commands and commands[command] == 1:
+        if commandAccess.get(command) == 1:
 
             if isinstance(message.author, discord.Member):
              await self.client.send_message(message.channel,\
              message.author.mention + ', the command `{}` is only available in private chat with me!'.format(command))
 
-             if not added:
+             if not result['added']:
                  await self.client.send_message(message.author, messages.markdown('<b>Try it here with: {}<b>\n'.format(command), self.messenger))
                  await self.client.send_message(message.author, messages.help(self.messenger))
 
@@ -256,7 +897,7 @@ class SmartProposalsBotDiscord(object):
             receiver = message.channel
 
         # If the command is admin only
-        if command in commands and commands[command] == 2:
+        if commandAccess.get(command) == 2:
 
             # Admin command got fired in a public chat
             if isinstance(message.author, discord.Member):
@@ -288,107 +929,208 @@ class SmartProposalsBotDiscord(object):
                 await self.sendMessage(receiver, (message.author.mention + ", " + commandhandler.unknown(self)))
                 return
 
-        ### DM Only ###
-        if command == 'subscribe':
-            response = commandhandler.subscription(self,message,True)
-            await self.sendMessage(receiver, response)
-        elif command == 'unsubscribe':
-            response = commandhandler.subscription(self,message,False)
-            await self.sendMessage(receiver, response)
-        elif command == 'add':
-            response = commandhandler.add(self, message, args)
-            await self.sendMessage(receiver, response)
-        elif command == 'remove':
-            response = commandhandler.remove(self, message, args)
-            await self.sendMessage(receiver, response)
-        elif command == 'watchlist':
-            response = commandhandler.watchlist(self, message)
-            await self.sendMessage(receiver, response)
-        ### Public ###
-        elif command == 'open':
-            response = commandhandler.open(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'latest':
-            response = commandhandler.latest(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'ending':
-            response = commandhandler.ending(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'detail':
-            response = commandhandler.detail(self,args)
-            await self.sendMessage(receiver, response)
-        elif command == 'passing':
-            response = commandhandler.passing(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'failing':
-            response = commandhandler.failing(self)
-            await self.sendMessage(receiver, response)
-        ### Admin command handler ###
-        elif command == 'stats':
-            response = commandhandler.stats(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'new':
-            response = commandhandler.new(self)
-            await self.sendMessage(receiver, response)
-        elif command == 'publish':
-            result = commandhandler.publish(self, message, args)
-
-            if result['fire']:
-                response = self.publishProposal(result['author'], result['proposal'])
-            else:
-                response = result['message']
-            await self.sendMessage(receiver, response)
+        handler = self.commandHandlers.get(command)
+
+        # Could not match any command. Send the unknwon command message.
+        if not handler:
+            await self.sendMessage(receiver, (message.author.mention + ", " + commandhandler.unknown(self)))
+            return
 
-        elif command == 'start':
-            response = commandhandler.stats(self)
-            await self.sendMessage(receiver, messages.welcome(self.messenger))
-        elif command == 'broadcast':
+        with commandhandler.commandSeconds.time(command=command):
 
-            response = None
+            response = handler(message, args)
 
-            if self.password:
-                response = " ".join(args[1:])
-            else:
-                response = " ".join(args)
+            if inspect.isawaitable(response):
+                response = await response
 
-            for dbUser in self.database.getUsers():
+            if response:
+                await self.sendMessage(receiver, response)
+
+    ######
+    # Command => handler(message, args) which returns the response or an
+    # awaitable for it. Handlers which need the database run on its thread.
+    ######
+    def setupCommands(self):
+
+        self.commandHandlers = {
+            ### DM Only ###
+            'subscribe': lambda message, args: self.asyncDatabase.run(commandhandler.subscription, self, message, True),
+            'unsubscribe': lambda message, args: self.asyncDatabase.run(commandhandler.subscription, self, message, False),
+            'add': lambda message, args: self.asyncDatabase.run(commandhandler.add, self, message, args),
+            'remove': lambda message, args: self.asyncDatabase.run(commandhandler.remove, self, message, args),
+            'watchlist': lambda message, args: self.asyncDatabase.run(commandhandler.watchlist, self, message),
+            ### Public ###
+            'help': lambda message, args: messages.help(self.messenger),
+            'open': lambda message, args: commandhandler.open(self),
+            'latest': lambda message, args: commandhandler.latest(self),
+            'ending': lambda message, args: commandhandler.ending(self),
+            'detail': lambda message, args: commandhandler.detail(self, args),
+            'passing': lambda message, args: commandhandler.passing(self),
+            'failing': lambda message, args: commandhandler.failing(self),
+            ### Admin command handler ###
+            'stats': lambda message, args: self.asyncDatabase.run(commandhandler.stats, self),
+            'new': lambda message, args: commandhandler.new(self),
+            'publish': self.publishCommand,
+            'broadcast': self.broadcastCommand,
+        }
 
-                member = self.findMember(dbUser['id'])
+    async def publishCommand(self, message, args):
 
-                if member:
-                    await self.sendMessage(member, response)
+        result = commandhandler.publish(self, message, args)
 
-        # Help message
-        elif command == 'help':
-            await self.sendMessage(receiver, messages.help(self.messenger))
+        if result['fire']:
+            # Publishing posts to the social media and writes to the
+            # databases, keep it off the event loop.
+            return await self.client.loop.run_in_executor(None, self.publishProposal, result['author'], result['proposal'])
 
-        # Could not match any command. Send the unknwon command message.
-        else:
-            await self.sendMessage(receiver, (message.author.mention + ", " + commandhandler.unknown(self)))
+        return result['message']
+
+    ######
+    # "broadcast <message>" sends the message to all users in the background,
+    # "broadcast status|cancel|resume" controls the latest broadcast.
+    ######
+    async def broadcastCommand(self, message, args):
+
+        if self.password:
+            args = args[1:]
+
+        text = " ".join(args)
+        action = text.lower() if len(args) == 1 else None
+        running = self.broadcast is not None and self.broadcast.running()
+
+        if action == 'cancel':
+
+            if not running:
+                return messages.markdown("No broadcast is running.", self.messenger)
+
+            self.broadcast.cancel()
+
+            return self.broadcast.status()
+
+        if action in ['status', 'resume'] and not running:
+
+            last = await self.asyncDatabase.getBroadcast()
+
+            if not last:
+                return messages.markdown("There was no broadcast yet.", self.messenger)
+
+            job = BroadcastJob(self, message.author, last)
+
+            if action == 'status' or job.state == database.broadcastDone:
+                job.pending = 0 if job.state == database.broadcastDone else await self.asyncDatabase.countUsers(job.cursor)
+                return job.status()
+
+            self.broadcast = job
+            self.broadcast.start()
+
+            return messages.markdown("Resumed broadcast <b>#{}<b>".format(job.broadcastId), self.messenger)
+
+        if running:
+
+            if action == 'status':
+                return self.broadcast.status()
+
+            return messages.markdown("Broadcast <b>#{}<b> is still running. Cancel it first.".format(self.broadcast.broadcastId), self.messenger)
+
+        if not len(text):
+            return messages.markdown("The broadcast message is missing.", self.messenger)
+
+        broadcastId = await self.asyncDatabase.addBroadcast(text)
+
+        self.broadcast = BroadcastJob(self, message.author, await self.asyncDatabase.getBroadcast(broadcastId))
+        self.broadcast.start()
+
+        return messages.markdown("Started broadcast <b>#{}<b>, progress reports follow.".format(broadcastId), self.messenger)
 
     ######
     # Unfortunately there is no better way to send messages to a user if you have
-    # only their userId. Therefor this method searched the discord user object
-    # in the global member list and returns is.
+    # only their userId. Therefor this method looks up the discord user object
+    # in the member index and returns it.
     ######
     def findMember(self, userId):
 
-        for member in self.client.get_all_members():
-            if int(member.id) == int(userId):
-                return member
+        member = self.memberIndex.find(userId)
 
-        logger.info ("Could not find the userId in the list?! {}".format(userId))
+        if not member:
+            logger.info ("Could not find the userId in the list?! {}".format(userId))
 
-        return None
+        return member
+
+    ######
+    # Store a notification for each of the :userIds in the outbox and queue
+    # the ones which were not yet planned. :fingerprint makes the keys
+    # unique for events which can happen more than once per proposal.
+    ######
+    def notifyUsers(self, event, proposal, message, userIds, priority, fingerprint = ''):
 
-    def notifyChannels(self,message):
+        entries = []
+
+        for userId in userIds:
+            key = "{}:{}:{}:{}".format(event, proposal.proposalId, fingerprint, userId)
+            entries.append((key, userId, proposal.proposalId, event, message, priority))
+
+        added = self.database.addToOutbox(entries)
+
+        # Deliver without the outbox rather than dropping the whole wave,
+        # it just doesn't survive a restart then.
+        if added is None:
+
+            self.adminCB("Outbox error, sending {} {} notifications without it".format(len(entries), event))
+
+            for key, userId, proposalId, event, message, priority in entries:
+                self.dispatchOutbox(None, userId, message, priority)
+
+            return
+
+        for key, userId, proposalId, event, message, priority in added:
+            self.dispatchOutbox(key, userId, message, priority)
+
+    ######
+    # Queue the outbox entry :key. Without :key the message gets queued
+    # without an outbox entry.
+    ######
+    def dispatchOutbox(self, key, userId, message, priority):
+
+        member = self.findMember(userId)
+
+        if member:
+            self.dispatcher.put(member, message, priority, [key] if key else None, coalesce=True)
+        elif key:
+            self.dispatcher.finished(key, False)
+
+    ######
+    # Queue the pending notifications of the outbox. Used to continue the
+    # delivery after a restart.
+    ######
+    def resumeOutbox(self):
+
+        resumed = 0
+        lastId = 0
+
+        while True:
+
+            entries = self.database.getPendingOutbox(lastId)
+
+            if not len(entries):
+                break
+
+            for entry in entries:
+                self.dispatchOutbox(entry['key'], entry['user_id'], entry['message'], entry['priority'])
+                lastId = entry['id']
+
+            resumed += len(entries)
+
+        if resumed:
+            logger.info("Resumed {} pending notifications".format(resumed))
+
+    def notifyChannels(self, message, priority = priorityHigh):
 
         for channelId in self.notifyChannelIds:
 
             channel = self.client.get_channel(channelId)
 
             if channel:
-                asyncio.run_coroutine_threadsafe(self.sendMessage(channel, message), loop=self.client.loop)
+                self.dispatcher.put(channel, message, priority)
 
     def publishProposal(self, author, proposal):
 
@@ -411,12 +1153,7 @@ class SmartProposalsBotDiscord(object):
 
             message = responses['message']
 
-            for userId in responses['userIds']:
-
-                member = self.findMember(userId)
-
-                if member:
-                    asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+            self.notifyUsers('published', proposal, message, responses['userIds'], priorityHigh)
 
             self.notifyChannels(message)
         else:
@@ -485,7 +1222,8 @@ class SmartProposalsBotDiscord(object):
         else:
             response += "No gab account given!"
 
-        self.proposals.db.updateProposal(proposal)
+        # Write the changed publishing states only
+        self.proposals.flush(updated=[proposal])
 
         self.notifyAdmins(messages.markdown(response, self.messenger))
 
@@ -503,7 +1241,7 @@ class SmartProposalsBotDiscord(object):
     def proposalPublishedCB(self, proposal):
 
         openCount = len(self.proposals.getOpenProposals())
-        asyncio.run_coroutine_threadsafe(self.client.change_presence(game=discord.Game(name='{} open Proposals'.format(openCount), type=3)), loop=self.client.loop)
+        self.schedule(self.client.change_presence(game=discord.Game(name='{} open Proposals'.format(openCount), type=3)))
 
         adminResponse = messages.publishedProposalNotificationAdmin(self.messenger, proposal)
 
@@ -515,12 +1253,7 @@ class SmartProposalsBotDiscord(object):
 
             message = responses['message']
 
-            for userId in responses['userIds']:
-
-                member = self.findMember(userId)
-
-                if member:
-                    asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+            self.notifyUsers('reminder', proposal, message, responses['userIds'], priorityHigh)
 
             self.notifyChannels(message)
 
@@ -543,12 +1276,7 @@ class SmartProposalsBotDiscord(object):
 
             message = responses['message']
 
-            for userId in responses['userIds']:
-
-                member = self.findMember(userId)
-
-                if member:
-                    asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+            self.notifyUsers('extended', proposal, message, responses['userIds'], priorityHigh, proposal.votingDeadline)
 
             self.notifyChannels(message)
 
@@ -564,12 +1292,13 @@ class SmartProposalsBotDiscord(object):
 
         responses = commandhandler.handleUpdatedProposal(self, updated, proposal)
 
-        for userId, message in responses.items():
+        if not len(responses['userIds']):
+            return
 
-            member = self.findMember(userId)
+        message = responses['message']
+        fingerprint = hashlib.sha1(message.encode('utf-8')).hexdigest()
 
-            if member:
-                asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+        self.notifyUsers('updated', proposal, message, responses['userIds'], priorityLow, fingerprint)
 
     ######
     # Callback for evaluating if someone in the database has won the reward
@@ -581,18 +1310,13 @@ class SmartProposalsBotDiscord(object):
     def proposalEndedCB(self, proposal):
 
         openCount = len(self.proposals.getOpenProposals())
-        asyncio.run_coroutine_threadsafe(self.client.change_presence(game=discord.Game(name='{} open Proposals'.format(openCount), type=3)), loop=self.client.loop)
+        self.schedule(self.client.change_presence(game=discord.Game(name='{} open Proposals'.format(openCount), type=3)))
 
         responses = commandhandler.handleEndedProposal(self, proposal)
 
         message = responses['message']
 
-        for userId in responses['userIds']:
-
-            member = self.findMember(userId)
-
-            if member:
-                asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+        self.notifyUsers('ended', proposal, message, responses['userIds'], priorityHigh)
 
         self.notifyChannels(message)
 
@@ -623,7 +1347,7 @@ class SmartProposalsBotDiscord(object):
             member = self.findMember(admin)
 
             if member:
-                asyncio.run_coroutine_threadsafe(self.sendMessage(member, message), loop=self.client.loop)
+                self.dispatcher.put(member, message, priorityNormal)
             else:
                 logger.warning("notifyAdmins - Could not find admin {}".format(admin))
 
@@ -641,6 +1365,6 @@ class SmartProposalsBotDiscord(object):
         admin = self.findMember(self.admins[0])
 
         if admin:
-            asyncio.run_coroutine_threadsafe(self.sendMessage(admin, message), loop=self.client.loop)
+            self.dispatcher.put(admin, message, priorityNormal)
         else:
             logger.warning("adminCB - Could not find admin.")
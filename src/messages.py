@@ -42,6 +42,36 @@ def splitMessage(text, split, maximum):
     else:
         return [text]
 
+######
+#
+# Cache for the rendered proposal messages. An entry is valid as long as
+# the version of the proposal and, for open proposals, the remaining time
+# text did not change.
+#
+#####
+
+class RenderCache(object):
+
+    def __init__(self):
+        # proposalId => {(render function, messenger) => (version, remaining, text)}
+        self.entries = {}
+
+    def get(self, render, messenger, proposal):
+
+        remaining = proposal.remainingString() if proposal.open() else None
+        entries = self.entries.setdefault(proposal.proposalId, {})
+        key = (render, messenger)
+        entry = entries.get(key)
+
+        if entry and entry[0] == proposal.version and entry[1] == remaining:
+            return entry[2]
+
+        text = render(messenger, proposal)
+
+        entries[key] = (proposal.version, remaining, text)
+
+        return text
+
 def removeMarkdown(text):
     clean = text.replace('_','')
     clean = clean.replace('*','')
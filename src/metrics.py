@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+import contextlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger("metrics")
+
+defaultBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(labels):
+
+    if not len(labels):
+        return ""
+
+    return "{" + ",".join(['{}="{}"'.format(name, escape(value)) for name, value in labels]) + "}"
+
+def formatValue(value):
+
+    if value == float('inf'):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#####
+#
+# Base of all metrics. The values get stored per combination of the
+# label values, the labels are passed as keyword arguments.
+#
+#####
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, description, labelNames = None):
+
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames) if labelNames else ()
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+
+        if set(labels.keys()) != set(self.labelNames):
+            raise ValueError("{} expects the labels {}".format(self.name, self.labelNames))
+
+        return tuple(str(labels[x]) for x in self.labelNames)
+
+    def samples(self):
+
+        with self.lock:
+            return [(self.name, list(zip(self.labelNames, key)), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, formatLabels(labels), formatValue(value)))
+
+        return "\n".join(lines)
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+######
+# Gauge with values set from outside or read from :function when the
+# metrics get rendered.
+######
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labelNames = None, function = None):
+        super(Gauge, self).__init__(name, description, labelNames)
+        self.function = function
+
+    def set(self, value, **labels):
+
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+
+        if self.function:
+
+            try:
+                return [(self.name, [], self.function())]
+            except Exception as e:
+                logger.error("gauge {}".format(self.name), exc_info=e)
+                return []
+
+        return super(Gauge, self).samples()
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelNames = None, buckets = None):
+        super(Histogram, self).__init__(name, description, labelNames)
+        self.buckets = sorted(buckets if buckets else defaultBuckets) + [float('inf')]
+
+    def observe(self, value, **labels):
+
+        key = self.key(labels)
+
+        with self.lock:
+
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self.values[key] = (counts, total + value)
+
+    ######
+    # Observe the seconds spent in the with block.
+    ######
+    @contextlib.contextmanager
+    def time(self, **labels):
+
+        start = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+
+        samples = []
+
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self.values.items())]
+
+        for key, counts, total in values:
+
+            labels = list(zip(self.labelNames, key))
+
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", labels + [('le', formatValue(bound))], count))
+
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, counts[-1]))
+
+        return samples
+
+#####
+#
+# All metrics of the process. Registering a name twice returns the
+# already registered metric.
+#
+#####
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, cls, name, *args, **kwargs):
+
+        with self.lock:
+
+            metric = self.metrics.get(name)
+
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError("{} is already registered as {}".format(name, metric.kind))
+            elif 'function' in kwargs:
+                metric.function = kwargs['function']
+
+        return metric
+
+    def render(self):
+
+        with self.lock:
+            metrics = [self.metrics[x] for x in sorted(self.metrics.keys())]
+
+        return "\n".join([x.render() for x in metrics]) + "\n"
+
+registry = Registry()
+
+def counter(name, description, labelNames = None):
+    return registry.register(Counter, name, description, labelNames)
+
+def gauge(name, description, labelNames = None, function = None):
+    return registry.register(Gauge, name, description, labelNames, function=function)
+
+def histogram(name, description, labelNames = None, buckets = None):
+    return registry.register(Histogram, name, description, labelNames, buckets)
+
+#####
+#
+# HTTP endpoint which serves the metrics in the Prometheus text format
+# at /metrics. Runs in a daemon thread.
+#
+#####
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class MetricsServer(object):
+
+    def __init__(self, host = '127.0.0.1', port = 9110):
+
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+
+        logger.info("Serving the metrics at http://{}:{}/metrics".format(self.host, self.port))
+
+    def stop(self):
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -2,28 +2,102 @@
 
 import os, stat
 import threading
+import contextlib
 import sqlite3 as sql
 import re
 
 import telegram
 import discord
 
+from src import metrics
+
+lockWaitSeconds = metrics.histogram('sqlite_write_lock_wait_seconds', 'Time spent waiting for the write lock of a database', ['database'])
+
+######
+#
+# Connection manager for an SQLite database in WAL mode. Every thread gets
+# its own connection so readers don't block each other or the writer.
+# Reads never commit, writes are serialized and run in explicit
+# transactions which get committed before the write lock is released.
+#
+######
+
 class ThreadedSQLite(object):
-    def __init__(self, dburi):
-        self.lock = threading.Lock()
-        self.connection = sql.connect(dburi, check_same_thread=False)
-        self.connection.row_factory = sql.Row
-        self.cursor = None
-    def __enter__(self):
-        self.lock.acquire()
-        self.cursor = self.connection.cursor()
-        return self
-    def __exit__(self, type, value, traceback):
-        self.lock.release()
-        self.connection.commit()
-        if self.cursor is not None:
-            self.cursor.close()
-            self.cursor = None
+
+    defaultPragmas = {'synchronous': 'NORMAL', 'cache_size': -8000, 'mmap_size': 0, 'busy_timeout': 5000}
+
+    def __init__(self, dburi, pragmas = None):
+        self.dburi = dburi
+        self.name = os.path.basename(dburi)
+        self.pragmas = dict(self.defaultPragmas)
+        self.pragmas.update(pragmas if pragmas else {})
+        self.local = threading.local()
+        self.writeLock = threading.Lock()
+        self.connections = []
+        self.connectionsLock = threading.Lock()
+        self.connect().execute("PRAGMA journal_mode=WAL")
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Transactions are controlled explicitly by write()
+            connection = sql.connect(self.dburi, check_same_thread=False, isolation_level=None)
+            connection.row_factory = sql.Row
+            for pragma, value in self.pragmas.items():
+                connection.execute("PRAGMA {}={}".format(pragma, value))
+            self.local.connection = connection
+            with self.connectionsLock:
+                # Close the connections of finished threads, the thread poller
+                # runs every cycle in a new timer thread.
+                for thread, stale in self.connections:
+                    if not thread.is_alive():
+                        stale.close()
+                self.connections = [x for x in self.connections if x[0].is_alive()]
+                self.connections.append((threading.current_thread(), connection))
+        return connection
+    @contextlib.contextmanager
+    def read(self):
+        cursor = self.connect().cursor()
+        try:
+            yield SQLiteContext(cursor)
+        finally:
+            cursor.close()
+    @contextlib.contextmanager
+    def write(self):
+        connection = self.connect()
+        with lockWaitSeconds.time(database=self.name):
+            self.writeLock.acquire()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                yield SQLiteContext(cursor)
+            except:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
+            finally:
+                cursor.close()
+        finally:
+            self.writeLock.release()
+    def script(self, script):
+        connection = self.connect()
+        with self.writeLock:
+            try:
+                connection.executescript(script)
+            except:
+                connection.rollback()
+                raise
+    def close(self):
+        with self.connectionsLock:
+            for thread, connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+class SQLiteContext(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
 
 def isInt(s):
     try:
@@ -4,15 +4,23 @@ import re
 import subprocess
 import json
 import time
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 
 import logging
 import threading
 import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import datetime, calendar
+import calendar
+import hashlib
+import random
+import bisect
 from src import util
+from src import metrics
 
 stateOpen = 'open'
 stateAllocated = 'allocated'
@@ -22,8 +30,30 @@ stateDeactivated = 'deactivated'
 
 validProposalStates = [stateOpen, stateAllocated, stateCompleted, stateNotFunded, stateDeactivated]
 
+portalRequestSeconds = metrics.histogram('proposals_portal_request_seconds', 'Duration of the voting portal requests', ['endpoint'])
+portalErrors = metrics.counter('proposals_portal_errors_total', 'Failed voting portal requests', ['endpoint'])
+pollSeconds = metrics.histogram('proposals_poll_seconds', 'Duration of a complete poll of the voting portal')
+updateSeconds = metrics.histogram('proposals_update_seconds', 'Time spent applying the changes of a poll')
+
+pollerThread = 'thread'
+pollerAsyncio = 'asyncio'
+
+validPollers = [pollerThread, pollerAsyncio]
+
 log = logging.getLogger("voting")
 
+######
+# Parse a date string of the voting portal into a UTC timestamp.
+######
+def proposalDateToEpoch(dateString):
+
+    try:
+        return calendar.timegm(time.strptime(dateString, '%Y-%m-%dT%H:%M:%S'))
+    except:
+        log.error("Date format changed? {}".format(dateString))
+
+    return None
+
 def proposalDateToString(dateString):
 
     try:
@@ -57,17 +87,76 @@ class LoadException(ProposalException):
         super(LoadException, self).__init__(2,message)
 
 class Proposal(object):
+
+    # Fields which are stored in the proposal database
+    columns = ['proposalId','proposalKey','title','url',
+               'summary','owner','amountSmart','amountUSD',
+               'installment','createdDate','votingDeadline','status',
+               'voteYes','voteNo','voteAbstain','percentYes',
+               'percentNo','percentAbstain','currentStatus','categoryTitle',
+               'approval','reminder','twitter','reddit','gab','discord']
+
+    storedFields = frozenset(columns)
+
+    # Fields with only a few distinct values, shared between all proposals
+    internedFields = frozenset(['status', 'currentStatus', 'categoryTitle'])
+
+    fields = frozenset(columns + ['telegram'])
+
+    __slots__ = columns + ['telegram', 'deadlineEpoch', 'createdEpoch', 'dirty', 'version']
+
     def __init__(self, data):
 
+        # Stored fields which changed since the last write
+        object.__setattr__(self, 'dirty', set())
+        # Gets increased with every change, used to invalidate cached renderings
+        object.__setattr__(self, 'version', 0)
+        # Parsed once from votingDeadline/createdDate
+        object.__setattr__(self, 'deadlineEpoch', None)
+        object.__setattr__(self, 'createdEpoch', None)
+
         for arg in data:
-            setattr(self, arg, data[arg])
+            # The portal may send more than we need
+            if arg in Proposal.fields:
+                setattr(self, arg, data[arg])
+
+        self.clean()
+
+    def __setattr__(self, name, value):
+
+        if name in Proposal.internedFields and isinstance(value, str):
+            value = sys.intern(value)
+
+        if name in Proposal.fields and\
+           (not hasattr(self, name) or getattr(self, name) != value):
+
+            object.__setattr__(self, 'version', self.version + 1)
+
+            if name in Proposal.storedFields:
+                self.dirty.add(name)
+
+        object.__setattr__(self, name, value)
+
+        if name == 'votingDeadline':
+            object.__setattr__(self, 'deadlineEpoch', proposalDateToEpoch(value))
+        elif name == 'createdDate':
+            object.__setattr__(self, 'createdEpoch', proposalDateToEpoch(value))
+
+    ######
+    # Mark the :fields or all fields as stored.
+    ######
+    def clean(self, fields = None):
+
+        if fields is None:
+            self.dirty.clear()
+        else:
+            self.dirty.difference_update(fields)
 
     def __str__(self):
         return "proposalId {}, status {}, currentStatus {}".format(self.proposalId,self.status, self.currentStatus)
 
     def __eq__(self, other):
-        return self.hash == other.hash and\
-                self.index == other.index
+        return self.proposalId == other.proposalId
 
     def __lt__(self, other):
         return self.proposalId < other.proposalId
@@ -134,15 +223,10 @@ class Proposal(object):
 
     def remainingSeconds(self):
 
-        seconds = 0
-
-        try:
-            d = datetime.datetime.strptime(self.votingDeadline, '%Y-%m-%dT%H:%M:%S')
-            seconds = calendar.timegm(d.timetuple()) - time.time()
-        except:
-            log.error("Date format changed?")
+        if self.deadlineEpoch is None:
+            return 0
 
-        return seconds
+        return self.deadlineEpoch - time.time()
 
 
     def valid(self):
@@ -184,14 +268,333 @@ class Proposal(object):
 
         return True
 
+######
+#
+# aiohttp connector which counts the connections it opens.
+#
+#####
+
+class CountingConnector(aiohttp.TCPConnector):
+
+    def __init__(self, *args, **kwargs):
+        super(CountingConnector, self).__init__(*args, **kwargs)
+        self.connections = 0
+
+    async def _create_connection(self, *args, **kwargs):
+        self.connections += 1
+        return await super(CountingConnector, self)._create_connection(*args, **kwargs)
+
+######
+#
+# Keep-alive connection pool shared by all requests to the voting portal.
+# Counts the requests and the opened connections to see how many
+# handshakes got saved by reusing connections.
+#
+# get is used by the thread poller, getAsync by the asyncio poller.
+#
+#####
+
+class PortalSession(object):
+
+    def __init__(self, poolSize = 4, keepAlive = True, gzip = True, listTimeout = 20, detailTimeout = 20):
+
+        self.poolSize = poolSize
+        self.keepAlive = keepAlive
+        self.gzip = gzip
+        self.timeouts = {'list': listTimeout, 'detail': detailTimeout}
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if gzip else 'identity'
+        self.session.headers['Connection'] = 'keep-alive' if keepAlive else 'close'
+
+        # Created on the first use to bind it to the running event loop
+        self.asyncSession = None
+        self.connector = None
+
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def get(self, url, endpoint, **kwargs):
+
+        with self.lock:
+            self.requests += 1
+
+        try:
+            with portalRequestSeconds.time(endpoint=endpoint):
+                response = self.session.get(url, timeout=self.timeouts[endpoint], **kwargs)
+        except Exception:
+            portalErrors.inc(endpoint=endpoint)
+            raise
+
+        if response.status_code >= 400:
+            portalErrors.inc(endpoint=endpoint)
+
+        return response
+
+    ######
+    # Non-blocking GET request. Returns a tuple (status, headers, content).
+    ######
+    async def getAsync(self, url, endpoint, headers = None):
+
+        with self.lock:
+            self.requests += 1
+
+        if not self.asyncSession:
+            self.connector = CountingConnector(limit=self.poolSize, force_close=not self.keepAlive)
+            self.asyncSession = aiohttp.ClientSession(connector=self.connector,
+                                                      headers={'Accept-Encoding': self.session.headers['Accept-Encoding']})
+
+        async def request():
+            async with self.asyncSession.get(url, headers=headers) as response:
+                return response.status, response.headers, await response.read()
+
+        try:
+            with portalRequestSeconds.time(endpoint=endpoint):
+                result = await asyncio.wait_for(request(), self.timeouts[endpoint])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            portalErrors.inc(endpoint=endpoint)
+            raise
+
+        if result[0] >= 400:
+            portalErrors.inc(endpoint=endpoint)
+
+        return result
+
+    def connections(self):
+
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+
+            pool = pools.get(key)
+
+            if pool:
+                connections += pool.num_connections
+
+        if self.connector:
+            connections += self.connector.connections
+
+        return connections
+
+    def stats(self):
+
+        connections = self.connections()
+
+        return {'requests': self.requests,
+                'connections': connections,
+                'reused': max(self.requests - connections, 0)}
+
+    def close(self):
+
+        self.session.close()
+
+        if self.asyncSession:
+
+            closed = self.asyncSession.close()
+
+            # Newer aiohttp versions close the session in a coroutine
+            if asyncio.iscoroutine(closed):
+                asyncio.ensure_future(closed)
+
+######
+#
+# Open proposals ordered by their voting deadline. Allows range lookups
+# for the proposals ending within a given time.
+#
+#####
+
+class DeadlineIndex(object):
+
+    def __init__(self):
+        # Sorted list of (deadlineEpoch, proposalId)
+        self.entries = []
+        # proposalId => its entry in the list
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    ######
+    # Add, move or remove the :proposal depending on its deadline and state.
+    ######
+    def update(self, proposal):
+
+        key = None
+
+        if proposal.open():
+            # Unknown deadlines count as ending now
+            key = (proposal.deadlineEpoch or 0, proposal.proposalId)
+
+        current = self.keys.get(proposal.proposalId)
+
+        if current == key:
+            return
+
+        if current:
+            del self.entries[bisect.bisect_left(self.entries, current)]
+            del self.keys[proposal.proposalId]
+
+        if key:
+            bisect.insort(self.entries, key)
+            self.keys[proposal.proposalId] = key
+
+    ######
+    # Returns the ids of the proposals with a deadline before :epoch.
+    ######
+    def until(self, epoch):
+        return [x[1] for x in self.entries[:bisect.bisect_left(self.entries, (epoch,))]]
+
+######
+#
+# Sorted ids of the proposals matching the filter :match. Gets updated
+# for every change instead of filtering all proposals for each request.
+#
+#####
+
+class ProposalView(object):
+
+    def __init__(self, match):
+        self.match = match
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, proposal):
+
+        id = proposal.proposalId
+        index = bisect.bisect_left(self.ids, id)
+        present = index < len(self.ids) and self.ids[index] == id
+        match = self.match(proposal)
+
+        if match and not present:
+            self.ids.insert(index, id)
+        elif not match and present:
+            del self.ids[index]
+
+######
+#
+# Calculates the delay until the next poll. Polls often if a deadline or
+# a 24h reminder is close or the votes are moving and backs off to long
+# intervals if nothing is open or nothing changed for a while.
+#
+#####
+
+class PollScheduler(object):
+
+    def __init__(self, interval = 120, minimum = 30, maximum = 900, jitter = 0.1):
+
+        if minimum <= 0 or minimum > interval or interval > maximum:
+            raise ValueError("Poll intervals must match 0 < min <= interval <= max")
+
+        if jitter < 0 or jitter >= 1:
+            raise ValueError("Poll jitter must be in the range [0, 1)")
+
+        self.interval = interval
+        self.minimum = minimum
+        self.maximum = maximum
+        self.jitter = jitter
+        # Number of polls in a row without any change
+        self.quietPolls = 0
+
+    def activity(self, changed):
+
+        if changed:
+            self.quietPolls = 0
+        else:
+            self.quietPolls += 1
+
+    ######
+    # Seconds until the next event of the open proposals in the DeadlineIndex
+    # :deadlines which needs a poll. That's the voting deadline or the 24h
+    # reminder, :proposals is used to look up the reminder state. Returns 0
+    # if a deadline passed recently and None if there is nothing to wait for.
+    # Deadlines passed longer than the max. interval ago don't count anymore,
+    # otherwise a proposal which never leaves the open state would pin the
+    # polls to the min. interval.
+    ######
+    def nextEvent(self, deadlines, proposals):
+
+        now = time.time()
+        entries = deadlines.entries
+
+        upcoming = bisect.bisect_left(entries, (now,))
+
+        if bisect.bisect_left(entries, (now - self.maximum,)) < upcoming:
+            return 0
+
+        nearest = entries[upcoming][0] - now if upcoming < len(entries) else None
+
+        # The first proposal not reminded yet with the reminder ahead
+        for epoch, id in entries[bisect.bisect_left(entries, (now + 24 * 60 * 60,)):]:
+
+            if not proposals[id].reminder:
+
+                reminder = epoch - 24 * 60 * 60 - now
+
+                if nearest is None or reminder < nearest:
+                    nearest = reminder
+
+                break
+
+        return nearest
+
+    ######
+    # Returns the seconds to wait until the next poll for the open
+    # proposals in the DeadlineIndex :deadlines, see nextEvent.
+    ######
+    def next(self, deadlines, proposals):
+
+        if not len(deadlines):
+            interval = self.maximum
+        else:
+            # Double the interval for each quiet poll
+            interval = self.interval * (2 ** min(self.quietPolls, 8))
+
+            # Halve the interval if the votes are moving
+            if not self.quietPolls:
+                interval /= 2
+
+            nearest = self.nextEvent(deadlines, proposals)
+
+            # Get closer the more the next event approaches
+            if nearest is not None:
+                interval = min(interval, nearest / 2)
+
+        if self.jitter:
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        return max(self.minimum, min(self.maximum, interval))
+
 class SmartCashProposals(object):
 
-    def __init__(self, db):
+    def __init__(self, db, session = None, detailWorkers = 4, poller = pollerThread, scheduler = None):
+
+        if not poller in validPollers:
+            raise ValueError("Invalid poller {}".format(poller))
 
         self.running = False
 
         self.db = db
         self.timer = None
+        self.task = None
+        self.poller = poller
+        self.scheduler = scheduler if scheduler else PollScheduler()
+        self.session = session if session else PortalSession()
+        # Workers to load the details of ended proposals concurrently
+        self.detailWorkers = detailWorkers
+        self.detailExecutor = ThreadPoolExecutor(max_workers=detailWorkers)
+        # The asyncio poller processes the results here. Storing the changes
+        # and the callbacks (database writes, social media posts) must not
+        # block the event loop.
+        self.updateExecutor = ThreadPoolExecutor(max_workers=1)
 
         self.url = "https://vote.smartcash.cc/api/"
         self.apiVersion = "v1"
@@ -204,32 +607,118 @@ class SmartCashProposals(object):
         self.proposalEndedCB = None
         self.errorCB = None
 
+        # Known proposals, the reference to detect changes. The database
+        # only gets written through.
         self.proposals = {}
-
-    def startTimer(self, timeout = 120):
-        self.timer = threading.Timer(timeout, self.updateProposals)
+        # Open proposals ordered by their deadline
+        self.deadlines = DeadlineIndex()
+        # Status views ordered by their id
+        self.openView = ProposalView(Proposal.open)
+        self.passingView = ProposalView(Proposal.passing)
+        self.failingView = ProposalView(Proposal.failing)
+        self.latestId = None
+        # Ids of stored proposals which could not be loaded
+        self.unloaded = set()
+        # Proposals which still need to be written, kept until the
+        # write succeeded
+        self.pendingAdds = {}
+        self.pendingUpdates = {}
+        # Flushes happen from the poller and from the bot (publishing)
+        self.flushLock = threading.Lock()
+
+        # Validators of the last completely processed open list. Used to
+        # skip the parsing and diffing if the portal has nothing new for us.
+        self.etag = None
+        self.lastModified = None
+        self.contentHash = None
+
+    def nextInterval(self):
+
+        interval = self.scheduler.next(self.deadlines, self.proposals)
+
+        log.info("Next poll in {} seconds".format(int(interval)))
+
+        return interval
+
+    def startTimer(self, timeout = None):
+        self.timer = threading.Timer(self.nextInterval() if timeout is None else timeout, self.updateProposals)
         self.timer.start()
 
-    def start(self):
+    ######
+    # Starts the polling. With the asyncio poller the poll task runs on
+    # :loop, the thread poller ignores it.
+    ######
+    def start(self, loop = None):
         log.info("start")
 
-        # Load proposals from the DB
+        # Load proposals from the DB. The memory is the reference for the
+        # changes from now on, the database only gets written through.
         for raw in self.db.getProposals():
 
             try:
                 proposal = Proposal.fromRaw(raw)
             except Exception as e:
                 log.error("Could not create proposal from raw data", exc_info = e)
+                self.unloaded.add(raw['proposalId'])
                 continue
             else:
 
                 if not proposal.valid():
                     self.error("Invalid proposal state - {}".format(proposal.status))
+                    self.unloaded.add(proposal.proposalId)
                 else:
                     self.proposals[proposal.proposalId] = proposal
+                    self.indexProposal(proposal)
+
+        # Stored proposals which are not in memory would get added again as
+        # new proposals, they get skipped by applyUpdate.
+        if len(self.unloaded):
+            self.error("Found {} proposals in the database which could not be loaded: {}".format(len(self.unloaded),
+                       ", ".join(["#{}".format(x) for x in sorted(self.unloaded)])))
 
         self.running = True
-        self.startTimer(1)
+
+        if self.poller == pollerAsyncio:
+            self.task = asyncio.ensure_future(self.pollAsync(1), loop=loop)
+        else:
+            self.startTimer(1)
+
+    ######
+    # Write the :added proposals and the changed fields of the :updated
+    # proposals in one transaction. Failed writes get retried with the
+    # next flush.
+    ######
+    def flush(self, added = [], updated = []):
+
+        with self.flushLock:
+
+            for proposal in added:
+                self.pendingAdds[proposal.proposalId] = proposal
+
+            for proposal in updated:
+                if len(proposal.dirty):
+                    self.pendingUpdates[proposal.proposalId] = proposal
+
+            if not len(self.pendingAdds) and not len(self.pendingUpdates):
+                return
+
+            log.info("Store {} new, {} changed proposals".format(len(self.pendingAdds), len(self.pendingUpdates)))
+
+            # Fields changed by another thread during the write stay dirty
+            written = {id: set(proposal.dirty) for id, proposal in self.pendingUpdates.items()}
+
+            if not self.db.storeProposals(list(self.pendingAdds.values()), list(self.pendingUpdates.values())):
+                log.error("Could not store the proposals, retry with the next flush")
+                return
+
+            for proposal in self.pendingAdds.values():
+                proposal.clean()
+
+            for id, proposal in self.pendingUpdates.items():
+                proposal.clean(written[id])
+
+            self.pendingAdds.clear()
+            self.pendingUpdates.clear()
 
     def error(self, message, exception = None):
 
@@ -241,103 +730,261 @@ class SmartCashProposals(object):
     def stop(self):
         log.info("stop")
 
+        self.running = False
+
+        if self.timer:
+            self.timer.cancel()
+
+        if self.task:
+            self.task.cancel()
+
+        self.detailExecutor.shutdown(wait=False)
+        self.updateExecutor.shutdown(wait=False)
+        self.session.close()
+
     def updateProposals(self):
 
-        self.update()
-        self.startTimer()
+        with pollSeconds.time():
+            self.update()
+
+        log.info("Portal connections: {requests} requests, {connections} opened, {reused} reused".format(**self.session.stats()))
+
+        if self.running:
+            self.startTimer()
+
+    ######
+    # Poll loop of the asyncio poller. Runs as task on the event loop of
+    # the bot, the requests are non-blocking. The results get processed and
+    # the callbacks called on the update thread.
+    ######
+    async def pollAsync(self, timeout):
+
+        while self.running:
+
+            await asyncio.sleep(timeout)
+
+            try:
+                with pollSeconds.time():
+                    await self.updateAsync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("updateAsync", exc_info=e)
+
+            log.info("Portal connections: {requests} requests, {connections} opened, {reused} reused".format(**self.session.stats()))
+
+            timeout = self.nextInterval()
+
+    def detailUrl(self, proposalId):
+        return self.url + self.apiVersion + self.detailEndpoint + str(proposalId)
+
+    def parseProposalDetail(self, proposalId, status, content):
+
+        if status != 200:
+            log.error("Request failed: {}".format(status))
+            raise LoadException("Invalid status code {}".format(status))
+
+        try:
+            detail = json.loads(content.decode('utf-8'))
+        except Exception as e:
+            raise JsonFormatException("Load proposal detail {}".format(str(e)))
+        else:
+
+            if not 'status' in detail:
+                raise LoadException("Invalid response: status missing!")
+
+            if not 'OK' in detail['status']:
+                raise LoadException("Invalid response: status not OK => {}".format(detail['status']))
+
+            if not 'result' in detail:
+                raise LoadException("Invalid response: result missing!")
+
+            raw = None
+
+            # Workaround because there is a typo in the json result
+            # Check both in case it gets fixed.
+            if 'proposal' in detail['result']:
+                raw = detail['result']['proposal']
+            elif 'propposal' in detail['result']:
+                raw = detail['result']['propposal']
+            else:
+                raise LoadException("Invalid response: proposal missing!")
+
+            try:
+                proposal = Proposal.fromRaw(raw)
+            except Exception as e:
+                raise LoadException("Parse proposal detail {}".format(str(e)))
+            else:
+
+                if proposal.proposalId != proposalId:
+                    raise LoadException("proposalId missmatch {} - {}".format(proposal.proposalId, proposalId))
+
+                return proposal
 
     def loadProposalDetail(self, proposalId):
         log.info("loadProposalDetail")
 
         try:
-            response = requests.get(self.url + self.apiVersion + self.detailEndpoint + str(proposalId),
-                         timeout=20)
+            response = self.session.get(self.detailUrl(proposalId), 'detail')
         except Exception as e:
             raise LoadException("Request exception {}".format(str(e)))
-        else:
 
-            if response.status_code != 200:
-                log.error("Request failed: {}".format(response.status_code))
-                raise LoadException("Invalid status code {}".format(response.status_code))
+        return self.parseProposalDetail(proposalId, response.status_code, response.content)
+
+    async def loadProposalDetailAsync(self, proposalId):
+        log.info("loadProposalDetailAsync")
+
+        try:
+            status, headers, content = await self.session.getAsync(self.detailUrl(proposalId), 'detail')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            raise LoadException("Request exception {}".format(str(e)))
+
+        return self.parseProposalDetail(proposalId, status, content)
+
+    ######
+    # Load the details of multiple proposals concurrently. Returns a dict with
+    # the proposalId as key and the loaded proposal or the raised exception
+    # as value.
+    ######
+    def loadProposalDetails(self, proposalIds):
+
+        futures = {}
+        details = {}
+
+        for proposalId in proposalIds:
+            futures[proposalId] = self.detailExecutor.submit(self.loadProposalDetail, proposalId)
+
+        for proposalId, future in futures.items():
 
             try:
-                detail = json.loads(response.text)
+                details[proposalId] = future.result()
             except Exception as e:
-                raise JsonFormatException("Load proposal detail {}".format(str(e)))
-            else:
+                details[proposalId] = e
 
-                if not 'status' in detail:
-                    raise LoadException("Invalid response: status missing!")
+        return details
 
-                if not 'OK' in detail['status']:
-                    raise LoadException("Invalid response: status not OK => {}".format(detail['status']))
+    async def loadProposalDetailsAsync(self, proposalIds):
 
-                if not 'result' in detail:
-                    raise LoadException("Invalid response: result missing!")
+        semaphore = asyncio.Semaphore(self.detailWorkers)
 
-                raw = None
+        async def load(proposalId):
+            async with semaphore:
+                return await self.loadProposalDetailAsync(proposalId)
 
-                # Workaround because there is a typo in the json result
-                # Check both in case it gets fixed.
-                if 'proposal' in detail['result']:
-                    raw = detail['result']['proposal']
-                elif 'propposal' in detail['result']:
-                    raw = detail['result']['propposal']
-                else:
-                    raise LoadException("Invalid response: proposal missing!")
+        results = await asyncio.gather(*[load(x) for x in proposalIds], return_exceptions=True)
 
-                try:
-                    proposal = Proposal.fromRaw(raw)
-                except Exception as e:
-                    raise LoadException("Parse proposal detail {}".format(str(e)))
-                else:
+        return dict(zip(proposalIds, results))
 
-                    if proposal.proposalId != proposalId:
-                        raise LoadException("proposalId missmatch {} - {}".format(proposal.proposalId, proposalId))
+    ######
+    # Update the indexes for a new or changed :proposal. Needs to be called
+    # before any callback gets fired for the change.
+    ######
+    def indexProposal(self, proposal):
 
-                    return proposal
+        self.deadlines.update(proposal)
+        self.openView.update(proposal)
+        self.passingView.update(proposal)
+        self.failingView.update(proposal)
 
-    def update(self):
+        if self.latestId is None or proposal.proposalId > self.latestId:
+            self.latestId = proposal.proposalId
 
-        log.info("update")
+    def checkReminder(self, proposal):
 
-        response = None
+        remainingSeconds = proposal.remainingSeconds()
 
-        try:
-            response = requests.get(self.url + self.apiVersion + self.openEndpoint,
-                         timeout=20)
-        except Exception as e:
-            log.error("Request exception: {}".format(e))
-            return
+        if not proposal.reminder and remainingSeconds and\
+            remainingSeconds < (24 * 60 * 60): # Remind 24hours before the end
 
-        if response.status_code != 200:
-            log.error("Request failed: {}".format(response.status_code))
-            return
+            proposal.reminder = 1
+
+            if self.proposalReminderCB:
+                self.proposalReminderCB(proposal)
+
+            return True
+
+        return False
+
+    def checkReminders(self):
+
+        reminded = []
+
+        for proposal in self.getOpenProposals(remaining=(24 * 60 * 60)):
+            if self.checkReminder(proposal):
+                reminded.append(proposal)
+
+        self.flush(updated=reminded)
+
+    def openListUrl(self):
+        return self.url + self.apiVersion + self.openEndpoint
+
+    def openListHeaders(self):
+
+        headers = {}
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+
+        if self.lastModified:
+            headers['If-Modified-Since'] = self.lastModified
+
+        return headers
+
+    ######
+    # Parse the response of the open list request. Returns None if there is
+    # nothing to update, otherwise a tuple with the dict of open proposals and
+    # the validators of the response to pass to applyUpdate.
+    ######
+    def parseOpenList(self, status, headers, content):
+
+        if status == 304:
+            log.info("Open list not modified")
+            self.scheduler.activity(False)
+            # The reminders depend on the time only, check them anyway.
+            self.checkReminders()
+            return None
+
+        if status != 200:
+            log.error("Request failed: {}".format(status))
+            return None
+
+        contentHash = hashlib.sha1(content).hexdigest()
+
+        if contentHash == self.contentHash:
+            log.info("Open list unchanged")
+            self.scheduler.activity(False)
+            self.checkReminders()
+            return None
+
+        validators = (headers.get('ETag'), headers.get('Last-Modified'), contentHash)
 
         try:
-            openList = json.loads(response.text)
+            openList = json.loads(content.decode('utf-8'))
         except Exception as e:
             log.error("Could not parse response", exc_info=e)
-            return
+            return None
         else:
 
             if not 'status' in openList:
                 log.error("Invalid response: status missing!")
-                return
+                return None
 
             if not 'OK' in openList['status']:
                 log.error("Invalid response: status not OK => {}".format(openList['status']))
-                return
+                return None
 
             if not 'result' in openList:
                 log.error("Invalid response: result missing!")
-                return
+                return None
 
             openProposalsJson = openList['result']
 
+            # An empty list is still a valid update, the proposals open
+            # before have ended.
             if not len(openProposalsJson):
                 log.info("Currently no proposal open for voting!")
-                return
 
             log.info("{} open proposals found".format(len(openProposalsJson)))
 
@@ -353,138 +1000,214 @@ class SmartCashProposals(object):
                 else:
                     openProposals[proposal.proposalId] = proposal
 
-            for id in self.proposals:
+            return openProposals, validators
 
-                proposal = self.proposals[id]
+    ######
+    # Returns the ids of the proposals which are not longer in the open list.
+    ######
+    def endedProposalIds(self, openProposals):
+        return [id for id, proposal in self.proposals.items() if not id in openProposals and proposal.open()]
 
-                if not id in openProposals:
+    def update(self):
 
-                    if not proposal.open():
-                        log.debug("Ended but was not open?!")
-                        continue
+        log.info("update")
 
-                    try:
-                        detailed = self.loadProposalDetail(id)
-                    except Exception as e:
-                        self.error("Could not load proposal {}".format(proposal.proposalId),e)
-                    else:
+        try:
+            response = self.session.get(self.openListUrl(), 'list', headers=self.openListHeaders())
+        except Exception as e:
+            log.error("Request exception: {}".format(e))
+            return
 
-                        updated = {
-                                    'voteYes' : None,
-                                    'voteNo' : None,
-                                    'voteAbstain' : None,
-                                    'status' : None,
-                                    'currentStatus' : None
-                                  }
+        parsed = self.parseOpenList(response.status_code, response.headers, response.content)
 
-                        for key in updated:
+        if not parsed:
+            return
 
-                            before = proposal.__getattribute__(key)
-                            after = detailed.__getattribute__(key)
-                            if before != after:
+        openProposals, validators = parsed
 
-                                log.info("#{} - update {}: B: {} A: {}".format(id, key, before, after))
-                                updated[key] = {'before':before, 'now': after}
-                                proposal.__setattr__(key,after)
+        details = self.loadProposalDetails(self.endedProposalIds(openProposals))
 
-                        if self.proposalEndedCB:
-                            self.proposalEndedCB(proposal)
+        with updateSeconds.time():
+            self.applyUpdate(openProposals, details, validators)
 
-                        self.db.updateProposal(proposal)
+    async def updateAsync(self):
 
-                        self.proposals[id] = proposal
+        log.info("updateAsync")
 
-                else:
+        try:
+            status, headers, content = await self.session.getAsync(self.openListUrl(), 'list', headers=self.openListHeaders())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("Request exception: {}".format(e))
+            return
+
+        loop = asyncio.get_event_loop()
+
+        # Also checks the reminders if nothing changed
+        parsed = await loop.run_in_executor(self.updateExecutor, self.parseOpenList, status, headers, content)
+
+        if not parsed:
+            return
+
+        openProposals, validators = parsed
+
+        details = await self.loadProposalDetailsAsync(self.endedProposalIds(openProposals))
+
+        with updateSeconds.time():
+            await loop.run_in_executor(self.updateExecutor, self.applyUpdate, openProposals, details, validators)
+
+    ######
+    # Compare the open proposals and the details of the ended ones with
+    # the known proposals, store the changes and fire the callbacks.
+    ######
+    def applyUpdate(self, openProposals, details, validators):
 
-                    dbProposal = self.db.getProposal(proposal.proposalId)
+        # Only remember the validators if the list got processed completely.
+        # Otherwise failed detail requests would not get retried.
+        complete = True
+        # Used to poll more often while the votes are moving
+        changed = False
+        # Proposals to write at the end of the cycle
+        added = []
+        modified = []
 
-                    if not dbProposal:
-                        log.error("Proposal not in DB. Should not happen!")
-                        continue
+        # Apply the changes ordered by id to keep the notifications deterministic.
+        for id in sorted(self.proposals):
 
-                    # Compare metrics!
-                    log.info("Compare {}".format(proposal.title))
+            proposal = self.proposals[id]
 
-                    updateNotify = {
+            if not id in openProposals:
+
+                if not proposal.open():
+                    log.debug("Ended but was not open?!")
+                    continue
+
+                detailed = details[id]
+
+                if isinstance(detailed, Exception):
+                    complete = False
+                    self.error("Could not load proposal {}".format(proposal.proposalId),detailed)
+                else:
+
+                    updated = {
                                 'voteYes' : None,
                                 'voteNo' : None,
                                 'voteAbstain' : None,
                                 'status' : None,
-                                'currentStatus' : None,
-                                'votingDeadline' : None,
+                                'currentStatus' : None
                               }
 
-                    updateOnly = ['percentYes','percentNo', 'percentAbstain', 'amountSmart', 'amountUSD']
+                    for key in updated:
 
-                    compare = Proposal.fromRaw(dbProposal)
-                    open = openProposals[id]
+                        before = proposal.__getattribute__(key)
+                        after = detailed.__getattribute__(key)
+                        if before != after:
 
-                    for key in updateNotify:
+                            log.info("#{} - update {}: B: {} A: {}".format(id, key, before, after))
+                            updated[key] = {'before':before, 'now': after}
+                            proposal.__setattr__(key,after)
 
-                        before = compare.__getattribute__(key)
-                        after = open.__getattribute__(key)
+                    self.indexProposal(proposal)
 
-                        if before != after:
+                    changed = True
 
-                            log.info("#{} - update notify {}: B: {} A: {}".format(id, key, before, after))
-                            updateNotify[key] = {'before':before, 'now': after}
-                            compare.__setattr__(key,after)
+                    if self.proposalEndedCB:
+                        self.proposalEndedCB(proposal)
 
-                    for key in updateOnly:
+                    modified.append(proposal)
 
-                        before = compare.__getattribute__(key)
-                        after = open.__getattribute__(key)
+            else:
 
-                        if before != after:
-                            log.info("#{} - update only {}: B: {} A: {}".format(id, key, before, after))
-                            compare.__setattr__(key,after)
+                # Compare metrics!
+                log.info("Compare {}".format(proposal.title))
+
+                updateNotify = {
+                            'voteYes' : None,
+                            'voteNo' : None,
+                            'voteAbstain' : None,
+                            'status' : None,
+                            'currentStatus' : None,
+                            'votingDeadline' : None,
+                          }
+
+                updateOnly = ['percentYes','percentNo', 'percentAbstain', 'amountSmart', 'amountUSD']
+
+                compare = proposal
+                open = openProposals[id]
+
+                for key in updateNotify:
+
+                    before = compare.__getattribute__(key)
+                    after = open.__getattribute__(key)
+
+                    if before != after:
 
-                    if sum(map(lambda x: x != None,list(updateNotify.values()))):
-                        log.info("Proposal updated!")
+                        log.info("#{} - update notify {}: B: {} A: {}".format(id, key, before, after))
+                        updateNotify[key] = {'before':before, 'now': after}
+                        compare.__setattr__(key,after)
 
-                        if self.proposalUpdatedCB:
-                            self.proposalUpdatedCB(updateNotify, compare)
+                for key in updateOnly:
 
-                    if updateNotify['votingDeadline']:
+                    before = compare.__getattribute__(key)
+                    after = open.__getattribute__(key)
 
-                        if self.proposalExtendedCB:
-                            self.proposalExtendedCB(compare)
-                    else:
+                    if before != after:
+                        log.info("#{} - update only {}: B: {} A: {}".format(id, key, before, after))
+                        compare.__setattr__(key,after)
 
-                        remainingSeconds = compare.remainingSeconds()
+                self.indexProposal(compare)
 
-                        if not compare.reminder and remainingSeconds and\
-                            remainingSeconds < (24 * 60 * 60): # Remind 24hours before the end
+                if sum(map(lambda x: x != None,list(updateNotify.values()))):
+                    log.info("Proposal updated!")
 
-                            compare.reminder = 1
+                    changed = True
 
-                            if self.proposalReminderCB:
-                                self.proposalReminderCB(compare)
+                    if self.proposalUpdatedCB:
+                        self.proposalUpdatedCB(updateNotify, compare)
 
-                    self.proposals[id] = compare
-                    self.db.updateProposal(compare)
+                if updateNotify['votingDeadline']:
 
-            for id, proposal in openProposals.items():
-                if not self.db.getProposal(id):
-                    log.info("Add {}".format(proposal.title))
+                    if self.proposalExtendedCB:
+                        self.proposalExtendedCB(compare)
+                else:
+                    self.checkReminder(compare)
+
+                modified.append(compare)
+
+        for id, proposal in openProposals.items():
+            if not id in self.proposals and not id in self.unloaded:
+                log.info("Add {}".format(proposal.title))
+
+                changed = True
 
-                    self.proposals[id] = proposal
+                self.proposals[id] = proposal
+                self.indexProposal(proposal)
 
-                    if not self.db.addProposal(proposal):
-                        log.warning("Could not add {}".format(proposal.title))
+                added.append(proposal)
 
-                    if self.proposalPublishedCB:
-                        self.proposalPublishedCB(proposal)
+                if self.proposalPublishedCB:
+                    self.proposalPublishedCB(proposal)
+
+        self.flush(added, modified)
+
+        self.scheduler.activity(changed)
+
+        if complete:
+            self.etag, self.lastModified, self.contentHash = validators
 
     def getOpenProposals(self, remaining = None):
 
         if remaining:
-            result = sorted(filter(lambda x: x.open() and x.remainingSeconds() < remaining, self.proposals.values()))
+            result = self.getProposals(self.deadlines.until(time.time() + remaining))
         else:
-            result = sorted(filter(lambda x: x.open(), self.proposals.values()))
+            result = self.viewProposals(self.openView)
 
         return result
 
+    def viewProposals(self, view):
+        return [self.proposals[x] for x in view.ids]
+
     def getProposal(self, proposalId):
 
         if proposalId in self.proposals:
@@ -504,16 +1227,16 @@ class SmartCashProposals(object):
 
     def getLatestProposals(self):
 
-        if len(self.proposals):
-            return sorted(list(self.proposals.values()))[-1]
+        if self.latestId is not None:
+            return self.proposals[self.latestId]
 
         return None
 
     def getPassingProposals(self):
-        return sorted(filter(lambda x: x.passing(),self.proposals.values()))
+        return self.viewProposals(self.passingView)
 
     def getFailingProposals(self):
-        return sorted(filter(lambda x: x.failing(),self.proposals.values()))
+        return self.viewProposals(self.failingView)
 
     def getNotPublishedProposals(self, twitter=False, reddit=False, gab=False, discord=False, telegram=False):
         return sorted(filter(lambda x: not x.published(twitter = twitter,\